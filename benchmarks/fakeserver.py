@@ -0,0 +1,187 @@
+# Copyright (C) 2012  Manolo Martínez <manolo@austrohungaro.com>
+#
+# This file is part or Greg.
+#
+# Greg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Greg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Greg.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A local HTTP server that serves synthetic podcasts, for benchmarking greg.
+
+Feed number n is served at /feed<n>.xml, and its entry number i (1 is the
+oldest) has its enclosure at /feed<n>/<i>.mp3. Entries are an hour apart and
+listed newest first. The server answers conditional and Range requests, can
+wait some time before every answer, and can fail the first request for some
+paths (always the same ones, so that runs are comparable) with a 503.
+"""
+import email.utils
+import http.server
+import threading
+import time
+import zlib
+
+# The date of the oldest entry of every feed
+FIRST_ENTRY = 1704067200
+
+
+class FakePodcastServer():
+    """
+    Serve synthetic podcasts on a free port of localhost, in a background
+    thread, for the duration of a with block
+    """
+    def __init__(self, entries=50, enclosure_size=100000, latency=0.0,
+                 failure_rate=0.0):
+        self.entries = entries
+        self.enclosure_size = enclosure_size
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.failed = set()  # the paths that have failed once already
+        self.reset()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+                                                      _Handler)
+        self.server.daemon_threads = True
+        self.server.podcasts = self
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def feed_url(self, number):
+        return "{}/feed{}.xml".format(self.url, number)
+
+    def reset(self):
+        """
+        Start counting requests afresh
+        """
+        with self.lock:
+            self.counts = {"feed": 0, "not modified": 0, "enclosure": 0,
+                           "failed": 0, "bytes": 0}
+
+    def count(self, kind, sent=0):
+        with self.lock:
+            self.counts[kind] += 1
+            self.counts["bytes"] += sent
+
+    def should_fail(self, path):
+        """
+        Fail the first request for a fixed share of the paths
+        """
+        if zlib.crc32(path.encode()) % 1000 >= self.failure_rate * 1000:
+            return False
+        with self.lock:
+            if path in self.failed:
+                return False
+            self.failed.add(path)
+        return True
+
+    def feed(self, name):
+        items = []
+        for number in range(self.entries, 0, -1):
+            date = email.utils.formatdate(FIRST_ENTRY + number * 3600,
+                                          usegmt=True)
+            items.append(
+                "<item><title>{name} episode {number}</title>"
+                "<link>{url}/{name}/{number}.html</link>"
+                "<description>&lt;p&gt;Episode {number} of {name}, in which "
+                "nothing much happens.&lt;/p&gt;</description>"
+                "<pubDate>{date}</pubDate>"
+                "<enclosure url=\"{url}/{name}/{number}.mp3\" "
+                "type=\"audio/mpeg\" length=\"{size}\"/></item>".format(
+                    name=name, number=number, url=self.url, date=date,
+                    size=self.enclosure_size))
+        return ("<?xml version=\"1.0\"?><rss version=\"2.0\"><channel>"
+                "<title>{0}</title><description>The {0} podcast</description>"
+                "{1}</channel></rss>".format(name, "".join(items))).encode()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        podcasts = self.server.podcasts
+        time.sleep(podcasts.latency)
+        if podcasts.should_fail(self.path):
+            podcasts.count("failed")
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        name, _, rest = self.path.strip("/").partition("/")
+        if name.endswith(".xml") and not rest:
+            self.send_feed(podcasts, name[:-len(".xml")])
+        elif rest.endswith(".mp3"):
+            self.send_enclosure(podcasts)
+        else:
+            self.send_error(404)
+
+    def send_feed(self, podcasts, name):
+        etag = '"{}-{}"'.format(name, podcasts.entries)
+        if self.headers.get("If-None-Match") == etag:
+            podcasts.count("not modified")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = podcasts.feed(name)
+        podcasts.count("feed", len(body))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/rss+xml")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_enclosure(self, podcasts):
+        size = podcasts.enclosure_size
+        start = 0
+        byterange = self.headers.get("Range", "")
+        if byterange.startswith("bytes=") and self.headers.get(
+                "If-Range") == '"enclosure"':
+            start = int(byterange[len("bytes="):].partition("-")[0] or 0)
+        if start >= size and start:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */{}".format(size))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        podcasts.count("enclosure", size - start)
+        if start:
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("ETag", '"enclosure"')
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        chunk = b"\0" * 65536
+        left = size - start
+        try:
+            while left > 0:
+                self.wfile.write(chunk[:min(left, len(chunk))])
+                left -= len(chunk)
+        except OSError:
+            pass  # greg has hung up
+
+    def log_message(self, *args):
+        pass
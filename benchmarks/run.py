@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# Copyright (C) 2012  Manolo Martínez <manolo@austrohungaro.com>
+#
+# This file is part or Greg.
+#
+# Greg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Greg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Greg.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Run greg against a local server of synthetic podcasts (see fakeserver.py), in
+a temporary data directory, and report how long each command takes, how much
+it downloads per second, its peak memory use and the requests it makes. Run
+it from the root of the repository:
+
+    python benchmarks/run.py
+    python benchmarks/run.py --feeds 50 --latency 0.05 --failure-rate 0.1
+
+The results are compared with those stored in benchmarks/baseline.json (if it
+was made with the same settings), and the script exits with status 1 if some
+command has become slower or hungrier by more than --tolerance, or makes more
+requests than it did. Use --save-baseline to store new results. Times depend
+on the machine, so the baseline is only meaningful on the machine it was made
+on; request counts are the same everywhere.
+
+The scenarios, run in this order, are:
+
+    sync        the first sync of every feed, downloading all entries
+    resync      a second sync, when nothing has changed
+    check       greg check of one feed
+    download    greg download of five of its entries
+    info        greg info of every feed
+    migrate     greg info, with the history of every feed in the text files
+                written by older versions of greg, which are imported
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from fakeserver import FakePodcastServer, FIRST_ENTRY
+
+RUNNER = ("import sys; sys.argv[0] = 'greg'; "
+          "from greg.parser import main; main()")
+
+SETTINGS = ["feeds", "entries", "size", "latency", "failure_rate", "jobs",
+            "downloads"]
+
+
+def run_greg(root, datadir, arguments):
+    """
+    Run a greg command to the end, and return the time it took and its peak
+    memory use (in MB)
+    """
+    command = [sys.executable, "-c", RUNNER, "--configfile",
+               os.path.join(datadir, "greg.conf"), "--datadirectory",
+               datadir] + arguments
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=root, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    # unlike process.wait(), wait4 tells us about the memory it used
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.perf_counter() - start
+    if process.returncode:
+        sys.exit("greg {} failed".format(" ".join(arguments)))
+    return elapsed, usage.ru_maxrss / 1024  # ru_maxrss is in KB on Linux
+
+
+def prepare(datadir, server, args):
+    """
+    Write a config file and a feed registry for the benchmark
+    """
+    with open(os.path.join(datadir, "greg.conf"), "w") as config:
+        config.write("[DEFAULT]\n"
+                     "Download directory = {}\n"
+                     "firstsync = all\n"
+                     "max_parallel_feeds = {}\n"
+                     "max_parallel_downloads = {}\n"
+                     "retry_backoff = 0.05\n".format(
+                         os.path.join(datadir, "downloads"), args.jobs,
+                         args.downloads))
+    with open(os.path.join(datadir, "data"), "w") as data:
+        for number in range(args.feeds):
+            data.write("[feed{}]\nurl = {}\ndate_info = available\n\n".format(
+                number, server.feed_url(number)))
+
+
+def write_legacy_history(datadir, server, args):
+    """
+    Write the history of every feed as older versions of greg did
+    """
+    for number in range(args.feeds):
+        with open(os.path.join(datadir, "feed{}".format(number)),
+                  "w") as history:
+            for entry in range(1, args.entries + 1):
+                linkdate = list(time.gmtime(FIRST_ENTRY + entry * 3600))
+                history.write(json.dumps(
+                    {"entrylink": "{}.mp3".format(entry),
+                     "linkdate": linkdate}) + "\n")
+
+
+def benchmark(root, args):
+    """
+    Run every scenario, and return the results
+    """
+    scenarios = [("sync", ["sync"]), ("resync", ["sync"]),
+                 ("check", ["check", "-f", "feed0"]),
+                 ("download", ["download", "-f", "feed0", "0-4"]),
+                 ("info", ["info"])]
+    results = {}
+    with FakePodcastServer(args.entries, args.size, args.latency,
+                           args.failure_rate) as server:
+        with tempfile.TemporaryDirectory() as datadir:
+            prepare(datadir, server, args)
+            for name, arguments in scenarios:
+                server.reset()
+                elapsed, rss = run_greg(root, datadir, arguments)
+                results[name] = measure(server, elapsed, rss)
+        with tempfile.TemporaryDirectory() as datadir:
+            prepare(datadir, server, args)
+            write_legacy_history(datadir, server, args)
+            server.reset()
+            elapsed, rss = run_greg(root, datadir, ["info"])
+            results["migrate"] = measure(server, elapsed, rss)
+    return results
+
+
+def measure(server, elapsed, rss):
+    counts = dict(server.counts)
+    return {"wall_time": round(elapsed, 3),
+            "throughput": round(counts.pop("bytes") / elapsed / 2**20, 2),
+            "peak_rss": round(rss, 1),
+            "requests": counts}
+
+
+def report(results):
+    print("{:<10}{:>10}{:>10}{:>10}{:>8}{:>8}{:>8}{:>8}".format(
+        "", "wall (s)", "MB/s", "RSS (MB)", "feeds", "304", "encl.",
+        "failed"))
+    for name, result in results.items():
+        requests = result["requests"]
+        print("{:<10}{:>10.3f}{:>10.2f}{:>10.1f}{:>8}{:>8}{:>8}{:>8}".format(
+            name, result["wall_time"], result["throughput"],
+            result["peak_rss"], requests["feed"], requests["not modified"],
+            requests["enclosure"], requests["failed"]))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the regressions with respect to baseline, and return how many
+    there are
+    """
+    regressions = 0
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for metric in ["wall_time", "peak_rss"]:
+            if result[metric] > before[metric] * (1 + tolerance):
+                print("{}: {} went from {} to {}".format(
+                    name, metric, before[metric], result[metric]))
+                regressions += 1
+        for kind, count in result["requests"].items():
+            if count > before["requests"].get(kind, 0):
+                print("{}: {} requests went from {} to {}".format(
+                    name, kind, before["requests"].get(kind, 0), count))
+                regressions += 1
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--feeds", type=int, default=20)
+    parser.add_argument("--entries", type=int, default=50,
+                        help="the number of entries of each feed")
+    parser.add_argument("--size", type=int, default=100000,
+                        help="the size of each enclosure, in bytes")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="how long the server waits before answering")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="the share of paths that fail the first time")
+    parser.add_argument("--jobs", type=int, default=4,
+                        help="max_parallel_feeds")
+    parser.add_argument("--downloads", type=int, default=4,
+                        help="max_parallel_downloads")
+    parser.add_argument("--baseline", default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="how much slower or bigger is still fine")
+    args = parser.parse_args()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    settings = {setting: getattr(args, setting) for setting in SETTINGS}
+    results = benchmark(root, args)
+    report(results)
+    if args.save_baseline:
+        with open(args.baseline, "w") as baselinefile:
+            json.dump({"settings": settings, "results": results},
+                      baselinefile, indent=2)
+            baselinefile.write("\n")
+        return
+    try:
+        with open(args.baseline) as baselinefile:
+            baseline = json.load(baselinefile)
+    except FileNotFoundError:
+        return
+    if baseline["settings"] != settings:
+        print("The baseline was made with other settings; not comparing.")
+        return
+    if compare(results, baseline["results"], args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
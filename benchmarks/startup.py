@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Copyright (C) 2012  Manolo Martínez <manolo@austrohungaro.com>
+#
+# This file is part or Greg.
+#
+# Greg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Greg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Greg.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Time how long "greg list" (or any other quick greg command) takes to run, and
+check that it doesn't import any of the modules that greg only needs for
+fetching, parsing and tagging feeds. Run it from the root of the repository:
+
+    python benchmarks/startup.py --runs 20 --max-ms 150
+
+It exits with status 1 if a heavy module is imported, or if the median time is
+above --max-ms.
+"""
+import argparse
+import json
+import os.path
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HEAVY_MODULES = ["feedparser", "requests", "bs4", "eyed3", "pkg_resources"]
+
+# Run greg in a fresh interpreter, and report which heavy modules it imported
+RUNNER = """
+import json, sys
+sys.argv[0] = "greg"
+from greg.parser import main
+try:
+    main()
+finally:
+    heavy = [name for name in {heavy!r} if name in sys.modules]
+    print(json.dumps(heavy), file=sys.stderr)
+"""
+
+
+def run_greg(root, arguments):
+    """
+    Run greg once, and return the time it took and the heavy modules it
+    imported
+    """
+    command = [sys.executable, "-c", RUNNER.format(heavy=HEAVY_MODULES)]
+    start = time.perf_counter()
+    result = subprocess.run(command + arguments, cwd=root,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    elapsed = time.perf_counter() - start
+    return elapsed, json.loads(result.stderr.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", nargs="*", default=["list"],
+                        help="the greg command to time (default: list)")
+    parser.add_argument("--runs", type=int, default=10,
+                        help="how many times to run it")
+    parser.add_argument("--feeds", type=int, default=200,
+                        help="how many feeds the registry should have")
+    parser.add_argument("--max-ms", type=float,
+                        help="fail if the median time is above this")
+    args = parser.parse_args()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as datadir:
+        configfile = os.path.join(datadir, "greg.conf")
+        with open(configfile, "w") as config:
+            config.write("[DEFAULT]\n")
+        with open(os.path.join(datadir, "data"), "w") as data:
+            for number in range(args.feeds):
+                data.write("[feed{0}]\nurl = http://example.com/{0}.xml\n\n"
+                           .format(number))
+        arguments = ["--configfile", configfile, "--datadirectory",
+                     datadir] + args.command
+        times = []
+        imported = set()
+        for run in range(args.runs):
+            elapsed, heavy = run_greg(root, arguments)
+            times.append(elapsed * 1000)
+            imported.update(heavy)
+    median = statistics.median(times)
+    print("greg {}: median {:.1f} ms, min {:.1f} ms, max {:.1f} ms "
+          "({} runs)".format(" ".join(args.command), median, min(times),
+                              max(times), args.runs))
+    failed = False
+    if imported:
+        print("Heavy modules imported: {}".format(", ".join(sorted(imported))))
+        failed = True
+    if args.max_ms is not None and median > args.max_ms:
+        print("The median is above {} ms".format(args.max_ms))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,8 +18,12 @@
 Defines auxiliary functions to be used elsewhere
 """
 
-import configparser
+import ast
+import calendar
+import hashlib
 import os
+import random
+import socket
 import subprocess
 import sys
 import re
@@ -27,26 +31,31 @@ import time
 import unicodedata
 import string
 import json
+from contextlib import contextmanager
+from urllib.error import URLError
+from urllib.parse import urlparse
 
-from pkg_resources import resource_filename
-import feedparser
-import requests
+from importlib.util import find_spec
 
-try:  # EyeD3 is an optional dependency
-    import eyed3
-    eyed3exists = True
-except ImportError:
-    eyed3exists = False
+# feedparser, requests, eyeD3 and BeautifulSoup take a while to import, and
+# many greg commands don't need them, so they are only imported by the
+# functions that use them
 
-try:  # beautifulsoup4 is an optional dependency
-    from bs4 import BeautifulSoup
-    beautifulsoupexists = True
+# EyeD3 is an optional dependency
+eyed3exists = find_spec("eyed3") is not None
+
+try:  # fcntl is only available on Unix-like systems
+    import fcntl
 except ImportError:
-    beautifulsoupexists = False
+    fcntl = None
+
+# beautifulsoup4 is an optional dependency
+beautifulsoupexists = find_spec("bs4") is not None
 
-config_filename_global = resource_filename(__name__, 'data/greg.conf')
+config_filename_global = os.path.join(os.path.dirname(__file__), 'data',
+                                      'greg.conf')
 
-# Registering a custom date handler for feedparser
+# A custom date handler for feedparser
 
 _feedburner_date_pattern = re.compile(
     r'\w+, (\w+) (\d{,2}), (\d{4}) - (\d{,2}):(\d{2})')
@@ -68,7 +77,20 @@ def feedburner_date_handler(aDateString):
     except AttributeError:
         return None
 
-feedparser.registerDateHandler(feedburner_date_handler)
+
+_feedparser = None
+
+
+def load_feedparser():
+    """
+    Import feedparser, registering our custom date handler the first time
+    """
+    global _feedparser
+    if _feedparser is None:
+        import feedparser
+        feedparser.registerDateHandler(feedburner_date_handler)
+        _feedparser = feedparser
+    return _feedparser
 
 # The following are some auxiliary functions
 
@@ -88,12 +110,161 @@ def ensure_dir(dirname):
             raise
 
 
-def parse_podcast(url):
+@contextmanager
+def file_lock(lockfilename, blocking=True):
+    """
+    Hold an exclusive advisory lock on lockfilename (where available) for the
+    duration of the block. If blocking is False, don't wait for the lock: the
+    block is given False if someone else holds it.
+    """
+    with open(lockfilename, 'a') as lockfile:
+        acquired = lock(lockfile, blocking)
+        try:
+            yield acquired
+        finally:
+            if fcntl and acquired:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def lock(openfile, blocking=True):
+    """
+    Take an exclusive advisory lock on openfile, which is released when the
+    file is closed. Return False if blocking is False and someone else holds
+    the lock.
+    """
+    if not fcntl:
+        return True
+    try:
+        fcntl.flock(openfile, fcntl.LOCK_EX | (0 if blocking else
+                                               fcntl.LOCK_NB))
+    except BlockingIOError:
+        return False
+    return True
+
+
+def file_stamps(filenames):
+    """
+    Return something that changes whenever one of the files is written, so
+    that what was read from them can be kept until then
+    """
+    stamps = []
+    for filename in filenames:
+        try:
+            status = os.stat(filename)
+            stamps.append((status.st_mtime_ns, status.st_size, status.st_ino))
+        except OSError:
+            stamps.append(None)
+    return stamps
+
+
+def write_atomically(filename, write):
+    """
+    Call write with a temporary file, and then put it in the place of filename
+    """
+    tempname = "{}.{}.tmp".format(filename, os.getpid())
+    try:
+        with open(tempname, 'w') as tempfile:
+            write(tempfile)
+            tempfile.flush()
+            os.fsync(tempfile.fileno())
+        os.replace(tempname, filename)
+    except BaseException:
+        if os.path.exists(tempname):
+            os.remove(tempname)
+        raise
+
+
+def http_session(pool_size):
+    """
+    Create the HTTP session that is used for every feed and download in a
+    greg command, so that connections to the same host are kept alive and
+    reused
+    """
+    import requests
+    http = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=32,
+                                            pool_maxsize=pool_size)
+    http.mount('http://', adapter)
+    http.mount('https://', adapter)
+    return http
+
+
+# Answers that mean the server is busy or struggling, rather than that we
+# have asked for something wrong
+_temporary_statuses = {408, 425, 429, 500, 502, 503, 504}
+
+
+def is_temporary(error):
+    """
+    Tell whether a failed request might go well if tried again a bit later
+    """
+    import requests
+    if isinstance(error, requests.HTTPError):
+        return (error.response is not None and
+                error.response.status_code in _temporary_statuses)
+    return isinstance(error, (requests.ConnectionError, requests.Timeout,
+                              requests.exceptions.ChunkedEncodingError))
+
+
+def with_retries(function, retries, backoff, deadline=None):
+    """
+    Call function, and call it again, up to retries more times, for as long as
+    it fails with a temporary network error. Before the n-th new try we wait a
+    random time of up to backoff * 2**(n-1) seconds, so that many greg
+    processes failing at once don't all come back at once. We give up early
+    rather than wait past deadline (a time.monotonic() value).
+    """
+    import requests
+    attempt = 0
+    while True:
+        try:
+            return function()
+        except requests.RequestException as error:
+            if attempt >= retries or not is_temporary(error):
+                raise
+            delay = random.uniform(0, backoff * 2 ** attempt)
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise
+            time.sleep(delay)
+            attempt += 1
+
+
+_feed_accept_header = ("application/atom+xml, application/rdf+xml, "
+                       "application/rss+xml, application/xml;q=0.9, "
+                       "text/xml;q=0.2, */*;q=0.1")
+
+
+@contextmanager
+def no_trace(phase, **args):
+    """
+    Stand in for Tracer.span when there is no tracer at hand
+    """
+    yield args
+
+
+def parse_podcast(url, etag=None, modified=None, http=None, timeout=None,
+                  retry=None, stop_at=None, digest=None, trace=no_trace):
     """
-    Try to parse podcast
+    Try to parse podcast. If etag or modified are given, the server may answer
+    that the feed hasn't changed, in which case the status of the result is 304
+    and it has no entries. If an HTTP session is given, the feed is fetched
+    with it (with the given timeout) and then handed over to feedparser; retry,
+    if given, is called with the function that does the fetching, and decides
+    whether it should be tried again when it fails (see Feed.retry). If
+    stop_at (a linkdate) is given, the entries that come after the newest ones
+    dated on or before it may be left out (see read_new_entries). The result
+    carries a hash of the document; if it is the same as digest, the feed is
+    not parsed, and the result is marked as unchanged. Fetching and parsing
+    are timed with trace (see Tracer.span).
     """
+    if http is not None and urlparse(url).scheme in ['http', 'https']:
+        podcast = fetch_podcast(url, etag, modified, http, timeout, retry,
+                                stop_at, digest, trace)
+    else:
+        with trace("parse"):
+            podcast = load_feedparser().parse(url, etag=etag,
+                                              modified=modified)
     try:
-        podcast = feedparser.parse(url)
         wentwrong = "urlopen" in str(podcast["bozo_exception"])
     except KeyError:
         wentwrong = False
@@ -102,8 +273,239 @@ def parse_podcast(url):
     return podcast
 
 
+def fetch_podcast(url, etag, modified, http, timeout, retry=None,
+                  stop_at=None, digest=None, trace=no_trace):
+    """
+    Fetch a feed with the HTTP session http, and parse it. Network and HTTP
+    errors are reported just as feedparser reports them.
+    """
+    import requests
+    feedparser = load_feedparser()
+    headers = {'User-Agent': feedparser.USER_AGENT,
+               'Accept': _feed_accept_header}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+
+    def get():
+        with http.get(url, headers=headers, timeout=timeout,
+                      stream=True) as response:
+            response.raise_for_status()
+            if stop_at and response.status_code != 304:
+                content, complete = read_new_entries(response, stop_at)
+            else:
+                content, complete = response.content, True
+        return response, content, complete
+    with trace("fetch") as span:
+        try:
+            response, content, complete = retry(get) if retry else get()
+        except requests.RequestException as error:
+            span["outcome"] = type(error).__name__
+            if error.response is not None:
+                span["status"] = error.response.status_code
+            return feedparser.FeedParserDict(
+                bozo=1, bozo_exception=URLError(error), entries=[],
+                feed=feedparser.FeedParserDict(), href=url)
+        span["status"] = response.status_code
+        span["bytes"] = len(content)
+        content_digest = hashlib.sha1(content).hexdigest()
+        if response.status_code == 304:
+            span["outcome"] = "not modified"
+        elif content_digest == digest:
+            span["outcome"] = "unchanged"
+    if response.status_code == 304 or content_digest == digest:
+        podcast = feedparser.FeedParserDict(
+            bozo=0, entries=[], feed=feedparser.FeedParserDict(),
+            unchanged=response.status_code != 304)
+    else:
+        response_headers = {key.lower(): value for key, value in
+                            response.headers.items()}
+        response_headers['content-location'] = response.url
+        # requests has already undone any gzip compression
+        response_headers.pop('content-encoding', None)
+        with trace("parse") as span:
+            podcast = feedparser.parse(content,
+                                       response_headers=response_headers)
+            span["entries"] = len(podcast.entries)
+        podcast['digest'] = content_digest
+    podcast['status'] = response.status_code
+    podcast['complete'] = complete
+    podcast['href'] = response.url
+    podcast['etag'] = response.headers.get('ETag')
+    podcast['modified'] = response.headers.get('Last-Modified')
+    return podcast
+
+
+_update_periods = {"hourly": 3600, "daily": 86400, "weekly": 604800,
+                   "monthly": 2592000, "yearly": 31536000}
+
+
+def feed_hints(podcast):
+    """
+    Read what a feed says about how often it changes: sy:updatePeriod and
+    sy:updateFrequency (it is updated frequency times every period) and <ttl>
+    (the number of minutes it can be cached for). Return both, in seconds, or
+    None where the feed says nothing usable.
+    """
+    feedinfo = podcast.get("feed", {})
+    interval = ttl = None
+    period = _update_periods.get(
+        feedinfo.get("sy_updateperiod", "").strip().lower())
+    if period:
+        try:
+            interval = period / max(1, int(feedinfo.get("sy_updatefrequency",
+                                                        "1")))
+        except ValueError:
+            interval = period
+    try:
+        ttl = int(feedinfo["ttl"]) * 60 or None
+    except (KeyError, ValueError):
+        pass
+    return interval, ttl
+
+
+def publishing_cadence(linkdates, count=10):
+    """
+    Estimate, from the dates of the entries of a feed, when it last published
+    and how often it does: the median gap between its count latest entries.
+    Both are in seconds (the first since the epoch), or None if there are too
+    few dates to tell.
+    """
+    times = set()
+    for linkdate in linkdates:
+        try:
+            times.add(calendar.timegm(tuple(linkdate)))
+        except (TypeError, ValueError, OverflowError):
+            continue
+    times = sorted(times, reverse=True)[:count + 1]
+    if not times:
+        return None, None
+    gaps = sorted(newer - older for newer, older in zip(times, times[1:]))
+    return times[0], gaps[len(gaps) // 2] if gaps else None
+
+
+def percentile(values, fraction):
+    """
+    Return the value below which the given fraction of values lie
+    (interpolating between the two nearest ones), or None if there are none
+    """
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+_prometheus_escapes = str.maketrans({"\\": "\\\\", "\"": "\\\"",
+                                     "\n": "\\n"})
+
+
+def prometheus_label(value):
+    """
+    Escape a label value for the Prometheus text format
+    """
+    return str(value).translate(_prometheus_escapes)
+
+
+# The elements that hold entries (in RSS 2.0, RSS 1.0 and Atom), and those
+# that give their date (first those that feedparser reads as published_parsed,
+# then those it reads as updated_parsed)
+_entry_elements = {"item", "{http://purl.org/rss/1.0/}item",
+                   "{http://www.w3.org/2005/Atom}entry"}
+_entry_date_elements = [["pubDate", "{http://www.w3.org/2005/Atom}published"],
+                        ["{http://www.w3.org/2005/Atom}updated",
+                         "{http://purl.org/dc/elements/1.1/}date"]]
+
+
+def entry_date(element):
+    """
+    Return the date of an entry element, as a linkdate, or None
+    """
+    try:
+        from feedparser.datetimes import _parse_date
+    except ImportError:
+        # This is not part of feedparser's public API. Without it, entries
+        # have no date, and read_new_entries reads the whole feed.
+        return None
+    load_feedparser()  # for our custom date handler
+    for tags in _entry_date_elements:
+        for tag in tags:
+            text = element.findtext(tag)
+            if text and text.strip():
+                parsed = _parse_date(text.strip())
+                if parsed:
+                    return list(parsed)
+    return None
+
+
+def read_new_entries(response, stop_at, old_entries=3):
+    """
+    Read a feed from a streamed response, entry by entry. Most feeds list their
+    newest entries first; if this one does, we stop reading once old_entries
+    entries in a row are dated on or before stop_at, and return a shorter
+    document with only the entries read so far. That saves reading and parsing
+    the rest of a big feed, whose entries are already in the history. (A few
+    old entries are kept, so that there is always some date information for
+    Feed.has_date.) If the entries turn out not to be in order, or the feed
+    cannot be read this way, the whole feed is returned instead. Return the
+    document, and whether it is the whole feed.
+    """
+    import xml.etree.ElementTree as ElementTree
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    chunks = []
+    ancestors = []  # the elements we are inside of
+    root = None
+    previous = None  # the date of the last entry read
+    in_order = True
+    old = 0  # the number of old entries in a row
+    # One iterator throughout, so that we can go on reading where we stopped
+    content = response.iter_content(chunk_size=65536)
+    try:
+        for chunk in content:
+            chunks.append(chunk)
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                if event == "start":
+                    if root is None:
+                        root = element
+                    ancestors.append(element)
+                    continue
+                ancestors.pop()
+                if element.tag not in _entry_elements:
+                    continue
+                date = entry_date(element)
+                if date is None or (previous is not None and date > previous):
+                    in_order = False
+                previous = date
+                if not in_order:
+                    break
+                old = old + 1 if date <= stop_at else 0
+                if old >= old_entries:
+                    # Everything from here on is older still. The parser has
+                    # already seen the rest of the chunk, so we cut the tree
+                    # short after this entry. Whatever comes after the entries
+                    # (which is seldom anything) is lost.
+                    response.close()
+                    child = element
+                    for ancestor in reversed(ancestors):
+                        del ancestor[list(ancestor).index(child) + 1:]
+                        child = ancestor
+                    return ElementTree.tostring(root), False
+            if not in_order:
+                break  # we'll need the whole feed after all
+    except ElementTree.ParseError:
+        pass  # feedparser may still make sense of it
+    return b"".join(chunks) + b"".join(content), True
+
+
 def html_to_text(data):
+    if "<" not in data and "&" not in data:
+        return data  # there is no markup to take out
     if beautifulsoupexists:
+        from bs4 import BeautifulSoup
         beautify = BeautifulSoup(data, "lxml")
         sanitizeddata = beautify.get_text()
     else:
@@ -165,9 +567,9 @@ def parse_for_download(args):
     return list_of_feeds
 
 
-def tag(placeholders):
+def what_to_tag(placeholders):
     """
-    Tag the file at podpath with the information in podcast and entry
+    Work out the path of the file to tag, and the tags to fill in it
     """
     # We first recover the name of the file to be tagged...
     template = placeholders.feed.retrieve_config("file_to_tag", "{filename}")
@@ -176,21 +578,17 @@ def tag(placeholders):
     # ... and this is it
 
     # now we create a dictionary of tags and values
-    tagdict = placeholders.feed.defaulttagdict  # these are the defaults
-    try:  # We do as if there was a section with potential tag info
-        feedoptions = placeholders.feed.config.options(placeholders.name)
-        # this monstruous concatenation of classes... surely a bad idea.
-        tags = [[option.replace("tag_", ""), placeholders.feed.config[
-            placeholders.name][option]] for option in feedoptions if "tag_" in
-                option]  # these are the tags to be filled
-        if tags:
-            for tag in tags:
-                tagdict[tag[0]] = tag[1]
-    except configparser.NoSectionError:
-        pass
-    for tag in tagdict:
-        metadata = placeholders.substitute(tagdict[tag])
-        tagdict[tag] = metadata
+    tagdict = {}
+    for tag, template in placeholders.feed.defaulttagdict.items():
+        tagdict[tag] = placeholders.substitute(template)
+    return podpath, tagdict
+
+
+def tag(podpath, tagdict):
+    """
+    Tag the file at podpath with the values in tagdict
+    """
+    import eyed3
     file_to_tag = eyed3.load(podpath)
     if file_to_tag.tag == None:
         file_to_tag.initTag()
@@ -204,65 +602,467 @@ def tag(placeholders):
         except AttributeError:
             setattr(file_to_tag.tag, mytag, tagdict[mytag])
     file_to_tag.tag.save()
-    
+
+
+class StageError(Exception):
+    """
+    A post-download stage failed. Along with the message, it carries the
+    timings of the stages done so far, the failed one included (see
+    run_stages), so that they can be traced all the same.
+    """
+    def __init__(self, message, timings):
+        # both go in args, so that the error can come back from a worker
+        # process
+        super().__init__(message, timings)
+        self.timings = timings
+
+    def __str__(self):
+        return self.args[0]
+
+
+def run_stages(stages):
+    """
+    Do the post-download work on an enclosure, one stage after the other (see
+    Feed.post_download_stages). This usually runs in a worker process, so
+    stages only carry plain values: ("tag", podpath, tagdict) or ("command",
+    name, instruction_list). Return how each stage went, as a list of (name,
+    process id, start, duration, outcome). If a stage fails, raise a
+    StageError with that list, which ends with the failed stage.
+    """
+    timings = []
+    for stage in stages:
+        start = time.time()
+        name = "tag" if stage[0] == "tag" else stage[1]
+        try:
+            if stage[0] == "tag":
+                tag(*stage[1:])
+            else:
+                run_command(stage[2], "the {} stage".format(name))
+        except Exception as error:
+            timings.append((name, os.getpid(), start, time.time() - start,
+                            type(error).__name__))
+            raise StageError(str(error), timings) from None
+        timings.append((name, os.getpid(), start, time.time() - start, "ok"))
+    return timings
+
+
+def run_command(instruction_list, what, timeout=None):
+    """
+    Run an external command, with its output captured, and return that
+    output. If the command fails or takes longer than timeout seconds, raise
+    a RuntimeError that says so (calling the command what) and shows the end
+    of its output.
+    """
+    def ending(output):
+        output = (output or b"").decode(errors="replace").strip()
+        return ":\n" + output[-1000:] if output else ""
+
+    try:
+        result = subprocess.run(instruction_list, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, timeout=timeout)
+    except subprocess.TimeoutExpired as expired:
+        raise RuntimeError("{} was stopped after {:g} seconds{}".format(
+            what, expired.timeout, ending(expired.output))) from None
+    if result.returncode:
+        raise RuntimeError("{} exited with status {}{}".format(
+            what, result.returncode, ending(result.stdout)))
+    return result.stdout
+
+
+# Filters are Python expressions, but only the following bits of Python are
+# allowed in them
+
+_filter_nodes = (
+    ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not,
+    ast.USub, ast.UAdd, ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE,
+    ast.Gt, ast.GtE, ast.In, ast.NotIn, ast.Is, ast.IsNot, ast.BinOp, ast.Add,
+    ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.IfExp, ast.Constant,
+    ast.JoinedStr, ast.FormattedValue, ast.Name, ast.Load, ast.Tuple, ast.List,
+    ast.Subscript, ast.Slice, ast.Call, ast.Attribute)
+
+_filter_functions = {"int": int, "float": float, "str": str, "len": len,
+                     "min": min, "max": max, "any": any, "all": all}
+
+_filter_methods = {"lower", "upper", "casefold", "strip", "startswith",
+                   "endswith", "find", "count", "split", "replace", "isdigit"}
+
+_filter_variable = re.compile(r"_placeholder_(\d+)_")
+
+
+class _FilterCompiler(ast.NodeTransformer):
+    """
+    Turn the placeholders of a filter into variables, checking along the way
+    that the filter only uses the allowed bits of Python
+    """
+    def __init__(self):
+        self.placeholders = set()  # the numbers of the placeholders used
+
+    def generic_visit(self, node):
+        if not isinstance(node, _filter_nodes):
+            raise ValueError("{} is not allowed in filters".format(
+                type(node).__name__))
+        return super().generic_visit(node)
+
+    def visit_Name(self, node):
+        match = _filter_variable.fullmatch(node.id)
+        if match:
+            # A placeholder outside quotes used to stand for Python code,
+            # so we read its value as a Python literal
+            self.placeholders.add(int(match.group(1)))
+            return ast.Call(func=ast.Name(id="_literal", ctx=ast.Load()),
+                            args=[node], keywords=[])
+        if node.id not in _filter_functions:
+            raise ValueError("unknown name in filter: {}".format(node.id))
+        return node
+
+    def visit_Constant(self, node):
+        if not isinstance(node.value, str):
+            return node
+        # A placeholder inside quotes becomes the equivalent of an f-string
+        parts = _filter_variable.split(node.value)
+        if len(parts) == 1:
+            return node
+        values = []
+        for position, part in enumerate(parts):
+            if position % 2:
+                self.placeholders.add(int(part))
+                values.append(ast.FormattedValue(
+                    value=ast.Name(id="_placeholder_{}_".format(part),
+                                   ctx=ast.Load()),
+                    conversion=-1, format_spec=None))
+            elif part:
+                values.append(ast.Constant(value=part))
+        return ast.JoinedStr(values=values)
+
+    def visit_Call(self, node):
+        function = node.func
+        if isinstance(function, ast.Attribute):
+            if function.attr not in _filter_methods:
+                raise ValueError("unknown method in filter: {}".format(
+                    function.attr))
+        elif not (isinstance(function, ast.Name) and
+                  function.id in _filter_functions):
+            raise ValueError("only some functions can be called in filters")
+        return self.generic_visit(node)
+
+    def visit_Attribute(self, node):
+        # attributes are only allowed as methods, see visit_Call
+        if node.attr not in _filter_methods:
+            raise ValueError("unknown method in filter: {}".format(node.attr))
+        return self.generic_visit(node)
+
+
+def _literal(value):
+    try:
+        return ast.literal_eval(str(value))
+    except (ValueError, SyntaxError):
+        return value
+
+
+def compile_filter(template):
+    """
+    Compile the filter template once, and return a function that tells
+    whether the entry described by some placeholders passes it. Placeholders
+    are handed to the filter as values, so quotes in (say) a title cannot
+    change what the filter means.
+    """
+    source = []
+    fields = []
+    for literal, field, format_spec, conversion in (
+            string.Formatter().parse(template)):
+        source.append(literal)
+        if field is not None:
+            if format_spec or conversion or not field.isidentifier():
+                raise ValueError("{{{}}} cannot be used in filters".format(
+                    field))
+            source.append("_placeholder_{}_".format(len(fields)))
+            fields.append(field)
+    try:
+        tree = ast.parse("".join(source).strip(), mode="eval")
+    except SyntaxError as error:
+        raise ValueError("Invalid filter {}: {}".format(template, error))
+    compiler = _FilterCompiler()
+    tree = ast.fix_missing_locations(compiler.visit(tree))
+    code = compile(tree, "<filter>", "eval")
+    variables = [("_placeholder_{}_".format(number), fields[number]) for
+                 number in sorted(compiler.placeholders)]
+
+    def condition(values):
+        namespace = dict(_filter_functions, _literal=_literal)
+        for variable, placeholder in variables:
+            namespace[variable] = values[placeholder]
+        return eval(code, {"__builtins__": {}}, namespace)
+    return condition
 
 
 def filtercond(placeholders):
-    template = placeholders.feed.retrieve_config("filter", "True")
-    condition = placeholders.substitute(template)
-    return eval(condition)
+    feed = placeholders.feed
+    if feed.condition is None:
+        feed.condition = compile_filter(feed.retrieve_config("filter",
+                                                             "True"))
+    return feed.condition(placeholders)
+
 
+def claim_partial_file(placeholders):
+    """
+    Find a name for the file to be downloaded, and claim its partial
+    (".part") file, by opening and locking it. Return its path, the open file
+    and, if a partial file left by an interrupted download of this very link
+    is around, what we know about it, so that the download can be resumed.
+    """
+    while True:
+        partpath = placeholders.fullpath + '.part'
+        # check if fullpath allready exists (several feeds, or several greg
+        # processes, may be downloading at the same time, so we claim the
+        # partial file in the same step)
+        if not os.path.exists(placeholders.fullpath):
+            try:
+                partfile = open(partpath, 'xb')
+                lock(partfile)
+                return partpath, partfile, None
+            except FileExistsError:
+                partinfo = read_partial_info(partpath)
+                if partinfo and partinfo.get('link') == placeholders.link:
+                    partfile = open(partpath, 'ab')
+                    if lock(partfile, blocking=False):
+                        return partpath, partfile, partinfo
+                    partfile.close()  # someone else is resuming it
+        next_filename(placeholders)
+
+
+def next_filename(placeholders):
+    placeholders.filename = placeholders.filename + '_'
+    placeholders.fullpath = os.path.join(
+        placeholders.directory, placeholders.filename)
+
+
+def move_into_place(placeholders, partpath):
+    """
+    Give a complete partial file its proper name, without ever overwriting a
+    file that someone else has put there in the meantime
+    """
+    while True:
+        try:
+            os.link(partpath, placeholders.fullpath)
+        except FileExistsError:
+            next_filename(placeholders)
+            continue
+        except OSError:
+            # the filesystem has no hard links
+            if os.path.exists(placeholders.fullpath):
+                next_filename(placeholders)
+                continue
+            os.replace(partpath, placeholders.fullpath)
+            return
+        os.remove(partpath)
+        return
 
-def get_date(line):
+
+def read_partial_info(partpath):
+    """
+    Read the sidecar of a partial file, which records the link it comes from
+    and the validators (ETag, Last-Modified) the server gave for it
+    """
     try:
-        history = json.loads(line)
-        if 'entrylink' in history and 'linkdate' in history:
-            return history['linkdate']
+        with open(partpath + '.info', 'r') as infofile:
+            return json.load(infofile)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def greg_download(feed, placeholders):
+    """
+    Greg's own download handler. The enclosure is written, chunk by chunk, to
+    a partial file that only gets its proper name when it is complete. If the
+    download is interrupted the partial file stays around, and the next
+    attempt asks the server only for the bytes that are missing.
+    """
+    partpath, partfile, partinfo = claim_partial_file(placeholders)
+    with partfile:  # we hold the lock on the partial file until we're done
+        try:
+            # if the connection fails half way, the next try resumes from
+            # whatever the previous one left in the partial file
+            feed.retry(lambda: fetch_to_partial_file(
+                feed, placeholders, partpath,
+                partinfo or read_partial_info(partpath)))
+        except BaseException:
+            if not partinfo and not read_partial_info(partpath):
+                # nothing worth resuming has been written
+                os.remove(partpath)
+            raise
+        move_into_place(placeholders, partpath)
+        os.remove(partpath + '.info')
+
+
+def fetch_to_partial_file(feed, placeholders, partpath, partinfo):
+    """
+    Write the enclosure to its partial file, resuming the download if
+    partinfo allows
+    """
+    chunk_size = int(feed.retrieve_config('download_chunk_size', '65536'))
+    infopath = partpath + '.info'
+    offset = os.path.getsize(partpath) if partinfo else 0
+    validator = partinfo and (partinfo.get('etag') or
+                              partinfo.get('last_modified'))
+    headers = {}
+    if offset and validator:
+        headers = {'Range': 'bytes={}-'.format(offset), 'If-Range': validator}
+    session = feed.session
+    http = session.http
+    timeout = feed.timeout
+    fin = http.get(placeholders.link, headers=headers, stream=True,
+                   timeout=timeout)
+    if fin.status_code == 416:
+        # Either the partial file is already complete, or it no longer
+        # matches what the server has; in the latter case, start afresh
+        fin.close()
+        total = fin.headers.get('Content-Range', '').rpartition('/')[2]
+        if total == str(offset):
+            return
+        fin = http.get(placeholders.link, stream=True, timeout=timeout)
+    with fin:
+        # check if request went ok
+        fin.raise_for_status()
+        if fin.status_code == 206:
+            mode = 'ab'  # the server honoured our Range request
         else:
-            print("Error reading history entry for {}. Contents:"
-                   "{}".format(infofile, history), file=sys.stderr,
-                   flush=True)
-            return False
-    except json.JSONDecodeError:
-        # Ignore JSONDecodeErrors as we'll fall through to our old method
-        pass
-    date = eval(line.split(sep=' ', maxsplit=1)[1])
-    return date
+            mode = 'wb'  # the server ignored it, so we start from byte zero
+            with open(infopath, 'w') as infofile:
+                json.dump({'link': placeholders.link,
+                           'etag': fin.headers.get('ETag'),
+                           'last_modified': fin.headers.get('Last-Modified')},
+                          infofile)
+        # write content to the partial file. If anything goes wrong, we leave
+        # it (and its sidecar) where it is, so that the download can be
+        # resumed
+        with open(partpath, mode) as fout:
+            for chunk in fin.iter_content(chunk_size=chunk_size):
+                fout.write(chunk)
+                feed.throttle(len(chunk))
+                if session.out_of_time():
+                    raise TimeoutError("the sync deadline has passed")
+
+
+_bandwidth_units = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30}
+
+_bandwidth_rate = re.compile(r"(\d+(?:\.\d*)?)\s*([KMG]?)", re.IGNORECASE)
+
+_bandwidth_window = re.compile(r"(\d\d?):(\d\d)\s*-\s*(\d\d?):(\d\d)\s+(.+)")
+
+
+def parse_bandwidth(value):
+    """
+    Read a bandwidth limit: a rate in bytes per second (with K, M or G for
+    powers of 1024) or "unlimited", possibly preceded by time-of-day windows
+    with rates of their own, as in "01:00-06:00 unlimited, 2M". Return a list
+    of (start, end, rate) windows, in minutes since midnight, and the rate
+    outside them. A rate of None means no limit.
+    """
+    def rate(text):
+        text = text.strip()
+        if text.lower() == "unlimited":
+            return None
+        match = _bandwidth_rate.fullmatch(text)
+        if not match:
+            raise ValueError("{} is not a valid bandwidth".format(text))
+        rate = float(match.group(1)) * _bandwidth_units[match.group(2).upper()]
+        return rate or None  # 0 means no limit, too
+
+    windows = []
+    default = None
+    for part in value.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        window = _bandwidth_window.fullmatch(part)
+        if window:
+            start_hour, start_minute, end_hour, end_minute = (
+                int(number) for number in window.groups()[:4])
+            windows.append((start_hour * 60 + start_minute,
+                            end_hour * 60 + end_minute, rate(window.group(5))))
+        else:
+            default = rate(part)
+    return windows, default
+
+
+def current_bandwidth(schedule, now=None):
+    """
+    Return the rate that a schedule (see parse_bandwidth) sets for the local
+    time now (by default, the present time)
+    """
+    windows, default = schedule
+    if not windows:
+        return default
+    moment = time.localtime(now)
+    minute = moment.tm_hour * 60 + moment.tm_min
+    for start, end, rate in windows:
+        if start <= minute < end or (end < start and (
+                minute >= start or minute < end)):  # windows can span midnight
+            return rate
+    return default
 
 
 def download_handler(feed, placeholders):
-    import shlex
     """
-    Parse and execute the download handler
+    Parse and execute the download handler. An external handler is run with
+    the priority set by handler_nice and handler_ionice, and is stopped after
+    handler_timeout seconds (or when the sync deadline comes). Its output is
+    only shown if it fails, in which case a RuntimeError is raised, so that
+    the entry is not recorded as downloaded.
     """
+    import shlex
     value = feed.retrieve_config('downloadhandler', 'greg')
     if value == 'greg':
-        with requests.get(placeholders.link) as fin:
-            # check if request went ok
-            fin.raise_for_status()
-            # check if fullpath allready exists
-            while os.path.isfile(placeholders.fullpath):
-                placeholders.filename = placeholders.filename + '_'
-                placeholders.fullpath = os.path.join(
-                    placeholders.directory, placeholders.filename)
-            # write content to file
-            with open(placeholders.fullpath,'wb') as fout:
-                fout.write(fin.content)
-    else:
-        value_list = shlex.split(value)
-        instruction_list = [placeholders.substitute(part) for
-                            part in value_list]
-        returncode = subprocess.call(instruction_list)
-        if returncode:
-            print("There was a problem with your download handler:"
-                    "{}".format(returncode), file=sys.stderr, flush=True)
+        greg_download(feed, placeholders)
+        return
+    instruction_list = [placeholders.substitute(part) for
+                        part in shlex.split(value)]
+    ionice = feed.retrieve_config('handler_ionice', '')
+    if ionice:
+        instruction_list = ["ionice"] + shlex.split(ionice) + instruction_list
+    niceness = int(feed.retrieve_config('handler_nice', '0'))
+    if niceness:
+        instruction_list = ["nice", "-n", str(niceness)] + instruction_list
+    timeout = float(feed.retrieve_config('handler_timeout', '0')) or None
+    deadline = feed.session.deadline
+    if deadline is not None:
+        left = max(0, deadline - time.monotonic())
+        timeout = left if timeout is None else min(timeout, left)
+    run_command(instruction_list, "the download handler", timeout)
+
 
+def send_to_daemon(socketpath, command, args):
+    """
+    Send a command to the greg daemon listening on socketpath, printing its
+    output as it comes. Return the exit status of the command, or None if no
+    daemon answers.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with client:
+        try:
+            client.connect(socketpath)
+        except OSError:
+            return None  # the daemon is gone, and has left its socket behind
+        request = {"command": command, "args": args}
+        client.sendall(json.dumps(request).encode() + b"\n")
+        streams = {"stdout": sys.stdout, "stderr": sys.stderr}
+        with client.makefile('rb') as answers:
+            for answer in answers:
+                message = json.loads(answer)
+                if "exit" in message:
+                    return message["exit"]
+                streams[message["stream"]].write(message["text"])
+                streams[message["stream"]].flush()
+    print("The greg daemon stopped before the command was done.",
+          file=sys.stderr, flush=True)
+    return 1
 
 
 def parse_feed_info(infofile):
     """
-    Take a feed file in .local/share/greg/data and return a list of links and
-    of dates
+    Take a feed file in .local/share/greg/data, as written by older versions
+    of greg, and return a list of links and of dates
     """
     entrylinks = []
     linkdates = []
@@ -312,14 +1112,13 @@ def pretty_print(session, feed):
     """
     if feed in session.feeds:
         print()
-        feed_info = os.path.join(session.data_dir, feed)
-        entrylinks, linkdates = parse_feed_info(feed_info)
+        latest = session.history.cutoff(feed)
         print(feed)
         print("-"*len(feed))
         print(''.join(["    url: ", session.feeds[feed]["url"]]))
-        if linkdates != []:
+        if latest is not None:
             print(''.join(["    Next sync will download from: ", time.strftime(
-                "%d %b %Y %H:%M:%S", tuple(max(linkdates))), "."]))
+                "%d %b %Y %H:%M:%S", tuple(latest)), "."]))
     else:
         print("You don't have a feed called {}.".format(feed), file=sys.stderr,
               flush=True)
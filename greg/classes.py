@@ -24,32 +24,395 @@ reads config files and data directory
 the subcommands
 
 * Placeholders: Calculates and stores the values of placeholders
+
+* History: Keeps track of the entries of each feed that have already been
+downloaded (or skipped)
+
+* Stats: Keeps statistics of every sync, feed by feed
+
+* FeedCache: Keeps the entries of recently fetched feeds, so that they don't
+have to be fetched and parsed again if they haven't changed
+
+* TokenBucket: Keeps downloads within a bandwidth limit
+
+* DownloadScheduler: Downloads the enclosures of all synced feeds, several at
+a time
+
+* PostProcessor: Tags the downloaded enclosures and runs the rest of the
+post-download stages on a pool of worker processes
+
+* GroupedOutput: Collects the output of each feed synced in parallel, so that
+the output of different feeds does not interleave
+
+* Tracer: Times the phases of a sync, for --trace and --events
+
+* Daemon: Keeps greg running in the background, syncing feeds when they are
+due and running the commands that other greg processes hand over to it
 """
 import configparser
+import contextvars
+import hashlib
 import os.path
+import signal
+import socketserver
+import sqlite3
 import sys
+import threading
 import time
+import traceback
 import json
-from pkg_resources import resource_filename
+import shlex
+from functools import cached_property, partial
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from urllib.parse import urlparse
 from urllib.error import URLError
 from warnings import warn
 
 import greg.aux_functions as aux
 
-config_filename_global = resource_filename(__name__, 'data/greg.conf')
+config_filename_global = os.path.join(os.path.dirname(__file__), 'data',
+                                      'greg.conf')
+
+# Where the output of the current command should go, if not to sys.stdout and
+# sys.stderr (see Daemon)
+output_sink = contextvars.ContextVar("output_sink", default=None)
 
 
 class Session():
-    def __init__(self, args):
+    def __init__(self, args, shared=None):
         self.args = args
         self.config_filename_user = self.retrieve_config_file()
+        # The daemon's session keeps the config files and the data file in
+        # memory for the commands it runs; they are only read again when they
+        # change (see refresh)
+        self.warm = shared if (shared is not None and
+                               shared.config_filename_user ==
+                               self.config_filename_user) else None
+        if self.warm is not None:
+            self.warm.refresh()
+            self.config = self.warm.config
+        else:
+            self.config = self.read_config()
         self.data_dir = self.retrieve_data_directory()
         self.data_filename = os.path.join(self.data_dir, "data")
-        self.feeds = configparser.ConfigParser()
-        self.feeds.read(self.data_filename)
-        self.config = configparser.ConfigParser()
-        self.config.read([config_filename_global, self.config_filename_user])
+        if self.warm is not None and (self.warm.data_filename !=
+                                      self.data_filename):
+            self.warm = None
+        if self.warm is not None:
+            self.lock = self.warm.lock  # guards self.feeds and self.changes
+            self.feeds = self.warm.feeds
+        else:
+            self.lock = threading.RLock()  # guards self.feeds and self.changes
+            self.feeds = self.read_feeds()
+        self.changes = []  # changes to self.feeds not yet saved to disk
+        self.lockfiles = {}  # the feed locks held by this session
+        self.scheduler = None  # downloads are done on the spot by default
+        self.postprocessor = PostProcessor(self)
+        self._history = None
+        self._http = None
+        self.cache = FeedCache(os.path.join(self.data_dir, "cache"), int(
+            self.retrieve_config('cache_size', '100')))
+        self.timeout = (float(self.retrieve_config('connect_timeout', '10')),
+                        float(self.retrieve_config('read_timeout', '60')))
+        self.deadline = None  # a time.monotonic() value, see out_of_time
+        self.tracer = Tracer(args.get('trace'), args.get('events'), keep=int(
+            self.retrieve_config('keep_stats', '90')) > 0)
+        if self.warm is not None:
+            # Reuse the history database, the HTTP connections and the
+            # bandwidth of the session the daemon keeps warm, unless this one
+            # has a data directory or config of its own
+            self._history = shared.history
+            self._http = shared.http
+            self.bandwidth = shared.bandwidth
+        else:
+            self.bandwidth = TokenBucket('total_bandwidth',
+                                         self.retrieve_config(
+                                             'total_bandwidth', 'unlimited'))
+
+    def read_config(self):
+        """
+        Read the config files
+        """
+        files = [config_filename_global, self.config_filename_user]
+        self.config_stamps = aux.file_stamps(files)
+        config = configparser.ConfigParser()
+        config.read(files)
+        return config
+
+    def read_feeds(self):
+        """
+        Read the data file, where the feeds are kept
+        """
+        self.feeds_stamps = aux.file_stamps([self.data_filename])
+        feeds = configparser.ConfigParser()
+        feeds.read(self.data_filename)
+        return feeds
+
+    def refresh(self):
+        """
+        Read the config files and the data file again, if they have been
+        written since they were read (by another greg process, say)
+        """
+        with self.lock:
+            if aux.file_stamps([config_filename_global,
+                                self.config_filename_user]) != \
+                    self.config_stamps:
+                self.config = self.read_config()
+            if aux.file_stamps([self.data_filename]) != self.feeds_stamps:
+                self.feeds = self.read_feeds()
+
+    @property
+    def history(self):
+        """
+        The history database, opened the first time it is needed
+        """
+        with self.lock:
+            if self._history is None:
+                # opening the history may mean importing old history files
+                with self.tracer.span("history"):
+                    self._history = History(self.data_dir,
+                                            self.feeds.sections())
+            return self._history
+
+    @property
+    def http(self):
+        """
+        The HTTP session shared by all feeds and downloads, created the first
+        time it is needed
+        """
+        with self.lock:
+            if self._http is None:
+                pool_size = (
+                    int(self.retrieve_config('max_parallel_feeds', '1')) +
+                    int(self.retrieve_config('max_parallel_downloads', '1')))
+                self._http = aux.http_session(pool_size)
+            return self._http
+
+    def add_feed(self, name, entry):
+        """
+        Add a feed to self.feeds, with the options in entry
+        """
+        self.change_feeds(("add", name, entry))
+
+    def remove_feed(self, name):
+        """
+        Remove a feed from self.feeds
+        """
+        self.change_feeds(("remove", name))
+
+    def set_feed_option(self, name, option, value):
+        """
+        Set an option of a feed in self.feeds, or remove it if value is None
+        """
+        with self.lock:
+            if self.feeds[name].get(option, raw=True) != value:
+                self.change_feeds(("set", name, option, value))
+
+    def change_feeds(self, change):
+        with self.lock:
+            self.apply_change(self.feeds, change)
+            self.changes.append(change)
+
+    @staticmethod
+    def apply_change(feeds, change):
+        if change[0] == "add":
+            feeds[change[1]] = change[2]
+        elif change[0] == "remove":
+            feeds.remove_section(change[1])
+        elif change[0] == "set":
+            name, option, value = change[1:]
+            if name != feeds.default_section and not feeds.has_section(name):
+                return  # the feed has been removed in the meantime
+            if value is None:
+                feeds.remove_option(name, option)
+            else:
+                feeds.set(name, option, value)
+
+    def save_feeds(self):
+        """
+        Write the changes made to self.feeds, if any, to the data file. Under a
+        lock, the file is read again and the changes are applied to it, so
+        that changes made by other greg processes are not lost; then it is
+        replaced in one go, so that it is never left half-written.
+        """
+        with self.lock:
+            if not self.changes:
+                return
+            with aux.file_lock(self.data_filename + ".lock"):
+                feeds = configparser.ConfigParser()
+                feeds.read(self.data_filename)
+                for change in self.changes:
+                    self.apply_change(feeds, change)
+                aux.write_atomically(self.data_filename, feeds.write)
+                self.feeds_stamps = aux.file_stamps([self.data_filename])
+            self.feeds = feeds
+            self.changes = []
+            if self.warm is not None:
+                # the commands that come after this one start from here
+                self.warm.feeds = feeds
+                self.warm.feeds_stamps = self.feeds_stamps
+
+    def start_deadline(self):
+        """
+        Start counting down sync_deadline, if there is one
+        """
+        deadline = float(self.retrieve_config('sync_deadline', '0'))
+        if deadline > 0:
+            self.deadline = time.monotonic() + deadline
+
+    def out_of_time(self):
+        """
+        Tell whether the deadline of the session, if any, has passed
+        """
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def suspended_until(self, name):
+        """
+        If a feed has failed too many times in a row to be synced for now,
+        return the time (in seconds since the epoch) of its next try
+        """
+        with self.lock:
+            skip_until = float(self.feeds[name].get("skip_until", "0"))
+        return skip_until if skip_until > time.time() else None
+
+    def is_due(self, name):
+        """
+        Tell whether a feed is worth fetching now, judging by how often it
+        publishes (see Feed.record_schedule). No feed goes unchecked for longer
+        than max_staleness seconds.
+        """
+        with self.lock:
+            feedinfo = self.feeds[name]
+            last_checked = float(feedinfo.get("last_checked", "0"))
+            newest = float(feedinfo.get("newest_entry", "0"))
+            interval = float(feedinfo.get("interval", "0"))
+            ttl = float(feedinfo.get("ttl", "0"))
+            failures = int(feedinfo.get("failures", "0"))
+        now = time.time()
+        if failures and now - last_checked < self.retry_delay(failures):
+            return False  # it failed last time, and will likely fail again
+        section = name if self.config.has_section(
+            name) else self.config.default_section
+        poll_interval = self.config.get(section, 'poll_interval', fallback='')
+        if poll_interval:
+            return now - last_checked >= float(poll_interval)
+        max_staleness = float(self.retrieve_config('max_staleness', '604800'))
+        if now - last_checked >= max_staleness:
+            return True
+        if now - last_checked < ttl:
+            return False  # the feed asks not to be fetched again so soon
+        if not interval:
+            return True  # we can't tell, so we'd better check
+        if not newest:
+            return now >= last_checked + interval
+        expected = newest + interval
+        if expected <= last_checked:
+            # The next entry is late. The later it gets, the less often we
+            # check, so that feeds that have stopped publishing are seldom
+            # fetched.
+            expected = last_checked + max(interval, last_checked - newest) / 2
+        return now >= expected
+
+    def retry_delay(self, failures):
+        """
+        Return how long a feed that has failed failures times in a row is
+        left alone by "greg sync --due": failure_cooldown, halved for every
+        failure short of failure_threshold (see record_failure)
+        """
+        threshold = int(self.retrieve_config('failure_threshold', '5'))
+        if not threshold:
+            return 0
+        cooldown = float(self.retrieve_config('failure_cooldown', '21600'))
+        return cooldown / 2 ** max(0, threshold - failures)
+
+    def record_failure(self, name):
+        """
+        Count a failed attempt to fetch a feed. After failure_threshold
+        failures in a row, the feed is left alone for failure_cooldown seconds.
+        Then it is tried once more, and left alone again if it fails again.
+        """
+        with self.lock:
+            if not self.feeds.has_section(name):
+                return
+            failures = int(self.feeds[name].get("failures", "0")) + 1
+            self.set_feed_option(name, "failures", str(failures))
+            # for "greg sync --due" (see is_due)
+            self.set_feed_option(name, "last_checked", str(int(time.time())))
+            threshold = int(self.retrieve_config('failure_threshold', '5'))
+            if threshold and failures >= threshold:
+                cooldown = float(self.retrieve_config('failure_cooldown',
+                                                      '21600'))
+                self.set_feed_option(name, "skip_until",
+                                     str(int(time.time() + cooldown)))
+
+    def record_success(self, name):
+        """
+        Forget the failures of a feed that could be fetched
+        """
+        with self.lock:
+            if not self.feeds.has_section(name):
+                return
+            self.set_feed_option(name, "failures", None)
+            self.set_feed_option(name, "skip_until", None)
+
+    def record_stats(self, started):
+        """
+        Store the statistics of the sync that began at started (a time.time()
+        value), and write them for Prometheus if so configured
+        """
+        keep = int(self.retrieve_config('keep_stats', '90'))
+        if keep <= 0:
+            return
+        stats = Stats(self.data_dir)
+        try:
+            stats.record(started, time.time() - started,
+                         self.tracer.recorded(), keep)
+            textfile = self.retrieve_config('prometheus_textfile', None)
+            if textfile:
+                aux.write_atomically(
+                    os.path.expanduser(textfile),
+                    lambda output: stats.write_prometheus(
+                        output, self.list_feeds()))
+        finally:
+            stats.close()
+
+    def lock_feed(self, name):
+        """
+        Take the lock of a feed, which is held until release_feed or
+        release_feeds is called. Return False if someone else (another greg
+        process, say) holds it.
+        """
+        lockdir = os.path.join(self.data_dir, "locks")
+        aux.ensure_dir(lockdir)
+        lockfile = open(os.path.join(lockdir, name + ".lock"), 'a')
+        if not aux.lock(lockfile, blocking=False):
+            lockfile.close()
+            return False
+        with self.lock:
+            self.lockfiles[name] = lockfile
+        return True
+
+    def release_feed(self, name):
+        """
+        Release the lock of a feed, if the session holds it. Locks are given
+        back as soon as a feed is done with, so that a sync of many feeds
+        doesn't keep a file open for each of them.
+        """
+        with self.lock:
+            lockfile = self.lockfiles.pop(name, None)
+        if lockfile is not None:
+            lockfile.close()
+
+    def release_feeds(self):
+        """
+        Release all feed locks held by the session
+        """
+        with self.lock:
+            lockfiles, self.lockfiles = self.lockfiles, {}
+        for lockfile in lockfiles.values():
+            lockfile.close()
 
     def list_feeds(self):
         """
@@ -70,6 +433,20 @@ class Session():
             pass
         return os.path.expanduser('~/.config/greg/greg.conf')
 
+    def retrieve_config(self, value, default):
+        """
+        Retrieves a global value (with a certain fallback) from the [DEFAULT]
+        section of the config files. As in Feed.retrieve_config, the command
+        line flag for the value, if used, overrides everything else
+        """
+        try:
+            if self.args[value]:
+                return self.args[value]
+        except KeyError:
+            pass
+        return self.config.get(self.config.default_section, value,
+                               fallback=default)
+
     def retrieve_data_directory(self):
         """
         Retrieve the data directory
@@ -83,8 +460,7 @@ class Session():
                 return args['datadirectory']
         except KeyError:
             pass
-        config = configparser.ConfigParser()
-        config.read([config_filename_global, self.config_filename_user])
+        config = self.config
         section = config.default_section
         data_path = config.get(section, 'Data directory',
                                fallback='~/.local/share/greg')
@@ -102,16 +478,52 @@ class Feed():
         self.args = session.args
         self.config = self.session.config
         self.name = feed
+        self.options, self.unresolved = self.resolve_config()
+        self.condition = None  # the compiled filter, see aux.filtercond
+        self.history = session.history
+        self.use_history = True
+        self.keep_validators = True
+        # Downloads and required stages still to be done for the feed, plus
+        # one for the sync itself (see sync_feed). The validators are saved,
+        # and the feed unlocked, once they are all done.
+        self.jobs = 1
+        self.timeout = (float(self.retrieve_config('connect_timeout', '10')),
+                        float(self.retrieve_config('read_timeout', '60')))
+        self.bandwidth = TokenBucket(
+            'feed_bandwidth', self.retrieve_config('feed_bandwidth',
+                                                   'unlimited'))
+        # times a phase of the work on this feed, see Tracer.span
+        self.trace = partial(session.tracer.span, feed=feed)
         if not podcast:
-            self.podcast = aux.parse_podcast(session.feeds[feed]["url"])
+            url = session.feeds[feed]["url"]
+            etag, modified, digest = self.stored_validators()
+            self.podcast = aux.parse_podcast(
+                url, etag, modified, http=session.http, timeout=self.timeout,
+                retry=self.retry, stop_at=self.stop_at(), digest=digest,
+                trace=self.trace)
+            if self.podcast.get("digest") and self.podcast["complete"]:
+                session.cache.save(url, self.podcast)
         else:
             self.podcast = podcast
-        self.sync_by_date = self.has_date()
+        self.wentwrong = False
+        if isinstance(self.podcast.get("bozo_exception"), URLError):
+            # We could not fetch the feed, so there is nothing else to find
+            # out (in particular, we don't want to record that it has no date
+            # information)
+            self.wentwrong = str(self.podcast["bozo_exception"])
+        # A 304 answer means that the feed hasn't changed since the last sync,
+        # so there is nothing else to find out either
+        self.notmodified = (self.podcast.get("status") == 304 or
+                            self.podcast.get("unchanged", False))
+        if self.notmodified or self.wentwrong:
+            return
+        with self.trace("has_date"):
+            self.sync_by_date = self.has_date()
+            self.record_entry_order()
         self.willtag = self.will_tag()
         if self.willtag:
             self.defaulttagdict = self.default_tag_dict()
         self.mime = self.retrieve_mime()
-        self.wentwrong = False
         if self.podcast.bozo: # the bozo bit is on, see feedparser docs
             warning = str(self.podcast["bozo_exception"])
             if "URLError" in warning:
@@ -119,36 +531,101 @@ class Feed():
             else:
                 warn("""This feed is malformed (possibly in unimportant ways):
                         {}""".format(warning), stacklevel=10)
-        self.info = os.path.join(session.data_dir, feed)
-        self.entrylinks, self.linkdates = aux.parse_feed_info(self.info)
+
+    def resolve_config(self):
+        """
+        Work out, once and for all, the value of every option for this feed.
+        Options are looked up first among the command line flags, then in the
+        section of the feed, then in [DEFAULT] (where the values in
+        config_filename_user take preeminence over those in
+        config_filename_global). Return an immutable mapping of options to
+        values, and the set of options that could not be interpolated.
+        """
+        section = self.name if self.config.has_section(
+            self.name) else self.config.default_section
+        options = {}
+        unresolved = set()
+        for option in self.config[section]:
+            try:
+                options[option] = self.config.get(section, option)
+            except configparser.InterpolationError:
+                # retrieve_config will raise the error, if the option is ever
+                # needed
+                unresolved.add(option)
+        for flag, value in self.args.items():
+            if value:
+                options[self.config.optionxform(flag)] = value
+                unresolved.discard(self.config.optionxform(flag))
+        return MappingProxyType(options), frozenset(unresolved)
 
     def retrieve_config(self, value, default):
         """
-        Retrieves a value (with a certain fallback) from the config files
-        (looks first into config_filename_global then into
-        config_filename_user. The latest takes preeminence) if the command line
-        flag for the value is used, that overrides everything else
+        Retrieves a value (with a certain fallback) from the options resolved
+        by resolve_config
         """
-        args = self.args
-        name = self.name
+        option = self.config.optionxform(value)
         try:
-            if args[value]:
-                return args[value]
+            return self.options[option]
         except KeyError:
             pass
-        section = name if self.config.has_section(
-            name) else self.config.default_section
-        answer = self.config.get(section, value, fallback=default)
-        return answer
+        if option in self.unresolved:
+            section = self.name if self.config.has_section(
+                self.name) else self.config.default_section
+            return self.config.get(section, value)
+        return default
+
+    def retry(self, function):
+        """
+        Call function (which fetches the feed or one of its enclosures), trying
+        again as set by the retries and retry_backoff options if it fails with
+        a temporary network error
+        """
+        return aux.with_retries(
+            function, int(self.retrieve_config('retries', '2')),
+            float(self.retrieve_config('retry_backoff', '1')),
+            self.session.deadline)
+
+    def throttle(self, size):
+        """
+        Having just downloaded size bytes, wait as long as feed_bandwidth and
+        total_bandwidth require
+        """
+        wait = max(self.bandwidth.reserve(size),
+                   self.session.bandwidth.reserve(size))
+        if wait > 0:
+            time.sleep(wait)
 
     def default_tag_dict(self):
-        defaultoptions = self.config.defaults()
-        tags = [[option.replace(
-            "tag_", ""), defaultoptions[option]] for option
-            in defaultoptions if "tag_" in option]
-        # these are the tags to be filled
+        tags = [[option.replace("tag_", ""), self.options[option]] for option
+                in self.options if "tag_" in option]
+        # these are the tags to be filled, with the [DEFAULT] values
+        # overridden by those in the section of the feed
         return dict(tags)
 
+    @cached_property
+    def podcasttitle(self):
+        try:
+            return self.podcast.title
+        except AttributeError:
+            return self.name
+
+    @cached_property
+    def filename_podcasttitle(self):
+        return aux.sanitize(self.podcasttitle)
+
+    @cached_property
+    def sanitizedsubtitle(self):
+        try:
+            # a feed without a subtitle is no failure of html_to_text
+            subtitle = self.podcast.feed.subtitle
+            with self.trace("html_to_text"):
+                sanitizedsubtitle = aux.html_to_text(subtitle)
+            if sanitizedsubtitle == "":
+                sanitizedsubtitle = "No description"
+        except AttributeError:
+            sanitizedsubtitle = "No description"
+        return sanitizedsubtitle
+
     def retrieve_download_path(self):
         """
         Retrieves the download path (looks first into config_filename_global
@@ -185,9 +662,7 @@ class Feed():
                           file=sys.stderr, flush=True)
                     sync_by_date = False
         if not sync_by_date:
-            session.feeds[name]["date_info"] = "not available"
-            with open(session.data_filename, 'w') as configfile:
-                session.feeds.write(configfile)
+            session.set_feed_option(name, "date_info", "not available")
         else:
             try:
                 if session.feeds[name]["date_info"] == "not available":
@@ -200,11 +675,104 @@ class Feed():
                            "on anything.").format(name))
             except KeyError:
                 pass
-            session.feeds[name]["date_info"] = "available"
-            with open(session.data_filename, 'w') as configfile:
-                session.feeds.write(configfile)
+            session.set_feed_option(name, "date_info", "available")
         return sync_by_date
 
+    def stored_validators(self):
+        """
+        Return the ETag and Last-Modified values that the server gave for
+        the feed the last time it was synced, and the hash of what it sent, if
+        we want a conditional GET
+        """
+        if self.retrieve_config('conditional_get', 'yes') != 'yes':
+            return None, None, None
+        feedinfo = self.session.feeds[self.name]
+        return (feedinfo.get("etag"), feedinfo.get("modified"),
+                feedinfo.get("digest"))
+
+    def stop_at(self):
+        """
+        Return the date up to which the history is complete (see
+        History.cutoff), if the feed has date information and lists its newest
+        entries first: the entries dated on or before it are not needed, so we
+        don't need to read all of them
+        """
+        if self.retrieve_config('incremental_parse', 'yes') != 'yes':
+            return None
+        feedinfo = self.session.feeds[self.name]
+        if (feedinfo.get("date_info") != "available" or
+                feedinfo.get("newest_first") != "yes"):
+            return None
+        return self.history.cutoff(self.name)
+
+    def record_entry_order(self):
+        """
+        If we have read the whole feed, note down whether it lists its newest
+        entries first, so that next time we know whether we can stop reading
+        it early (see stop_at)
+        """
+        if (not self.podcast.get("complete", True) or
+                not self.session.feeds.has_section(self.name)):
+            return
+        dates = [entry.get("published_parsed") or entry.get("updated_parsed")
+                 for entry in self.podcast.entries]
+        newest_first = all(dates) and all(
+            newer >= older for newer, older in zip(dates, dates[1:]))
+        self.session.set_feed_option(self.name, "newest_first",
+                                     "yes" if newest_first else "no")
+
+    def store_validators(self):
+        """
+        Save the ETag and Last-Modified values of the feed, and the hash of
+        the feed, so that the next sync can skip it if it hasn't changed
+        """
+        session = self.session
+        with session.lock:
+            if not self.keep_validators:
+                return
+            for key in ["etag", "modified", "digest"]:
+                value = self.podcast.get(key)
+                if value:
+                    # the data file is read with interpolation
+                    value = value.replace("%", "%%")
+                session.set_feed_option(self.name, key, value or None)
+
+    def start_job(self):
+        """
+        Note that a download or stage of the feed has been queued, so that
+        neither the validators are saved nor the feed is unlocked before it
+        is done
+        """
+        with self.session.lock:
+            self.jobs += 1
+
+    def finish_job(self):
+        """
+        Note that a download or stage of the feed is done (or, for sync_feed,
+        that every entry has been queued). Once nothing is left to do, save
+        the validators, unless something went wrong (see forget_validators),
+        and unlock the feed.
+        """
+        with self.session.lock:
+            self.jobs -= 1
+            done = not self.jobs
+        if done:
+            try:
+                self.store_validators()
+            finally:
+                self.session.release_feed(self.name)
+
+    def forget_validators(self):
+        """
+        Make sure that the next sync fetches the feed in full (for example,
+        because one of its downloads failed)
+        """
+        session = self.session
+        with session.lock:
+            self.keep_validators = False
+            for key in ["etag", "modified", "digest"]:
+                session.set_feed_option(self.name, key, None)
+
     def will_tag(self):
         """
         Check whether the feed should be tagged
@@ -226,12 +794,13 @@ class Feed():
         """
         Ascertain where to start downloading, and how many entries.
         """
-        if self.linkdates != []:
+        latest = self.history.cutoff(self.name)
+        if latest is not None:
             # What follows is a quick sanity check: if the entry date is in the
             # future, this is probably a mistake, and we just count the entry
             # date as right now.
-            if max(self.linkdates) <= list(time.localtime()):
-                currentdate = max(self.linkdates)
+            if latest <= list(time.localtime()):
+                currentdate = latest
             else:
                 currentdate = list(time.localtime())
                 print(("This entry has its date set in the future. "
@@ -248,6 +817,30 @@ class Feed():
                 stop = int(firstsync)
         return currentdate, stop
 
+    def record_schedule(self):
+        """
+        Record when the feed was checked and, as far as we can tell, when it
+        last published and how often it does, so that "greg sync --due" knows
+        when it is worth checking again
+        """
+        schedule = {"last_checked": str(int(time.time()))}
+        if not self.notmodified:
+            interval, ttl = aux.feed_hints(self.podcast)
+            newest = None
+            if self.sync_by_date:
+                linkdates = [entry.get("published_parsed") or
+                             entry.get("updated_parsed") for entry in
+                             self.podcast.entries]
+                linkdates += self.history.linkdates(self.name, 10)
+                newest, estimate = aux.publishing_cadence(linkdates)
+                interval = estimate or interval
+            for key, value in [("newest_entry", newest),
+                               ("interval", interval), ("ttl", ttl)]:
+                schedule[key] = str(int(value)) if value else None
+        with self.session.lock:
+            for key, value in schedule.items():
+                self.session.set_feed_option(self.name, key, value)
+
     def fix_linkdate(self, entry):
         """
         Give a date for the entry, depending on feed.sync_by_date
@@ -312,86 +905,1378 @@ class Feed():
             downloadlinks[urlparse(entry.link).query.split(
                 "/")[-1]] = entry.link
         for podname in downloadlinks:
-            if (podname, entry.linkdate) not in zip(self.entrylinks,
-                                                    self.linkdates):
+            if not (self.use_history and self.history.contains(
+                    self.name, podname, entry.linkdate)):
                 try:
                     title = entry.title
                 except:
                     title = podname
-                try:
-                    sanitizedsummary = aux.html_to_text(entry.summary)
-                    if sanitizedsummary == "":
-                        sanitizedsummary = "No summary available"
-                except:
-                    sanitizedsummary = "No summary available"
                 placeholders = Placeholders(
-                    self, entry, downloadlinks[podname], podname, title,
-                    sanitizedsummary)
+                    self, entry, downloadlinks[podname], podname, title)
                 placeholders = aux.check_directory(placeholders)
-                condition = aux.filtercond(placeholders)
+                with self.trace("filter", entry=podname) as span:
+                    condition = span["passed"] = aux.filtercond(placeholders)
                 if condition:
                     print("Downloading {} -- {}".format(title, podname))
-                    aux.download_handler(self, placeholders)
-                    if self.willtag:
-                        aux.tag(placeholders)
+                    if self.use_history:
+                        self.history.hold(self.name, podname, entry.linkdate)
+                    if self.session.scheduler:
+                        self.session.scheduler.submit(
+                            self, placeholders, podname, entry.linkdate)
+                    else:
+                        self.download_enclosure(placeholders, podname,
+                                                entry.linkdate)
                     downloaded = True
                 else:
                     print("Skipping {} -- {}".format(title, podname))
                     downloaded = False
-                if self.info:
-                    with open(self.info, 'a') as current:
-                        # We write to file this often to ensure that
-                        # downloaded entries count as downloaded.
-                        json.dump({'entrylink': podname, 'linkdate': entry.linkdate}, current)
-                        current.write('\n')
+                    self.append_history(podname, entry.linkdate)
         return downloaded
 
+    def download_enclosure(self, placeholders, podname, linkdate):
+        """
+        Download a single enclosure, and hand it over to the post-processor,
+        which records it in the history once it is tagged and so on
+        """
+        with self.trace("download", entry=podname) as span:
+            aux.download_handler(self, placeholders)
+            try:
+                span["bytes"] = os.path.getsize(placeholders.fullpath)
+            except OSError:
+                pass  # an external handler may have put it somewhere else
+        self.session.postprocessor.submit(self, placeholders, podname,
+                                          linkdate)
+
+    def post_download_stages(self, placeholders):
+        """
+        The work to do on a downloaded enclosure: tagging, if so configured,
+        and then the stages listed in the stages option. Return two lists of
+        stages (see aux.run_stages): those that have to be done before the
+        entry counts as downloaded, and those listed in optional_stages.
+        """
+        required = []
+        optional = []
+        if self.willtag:
+            required.append(("tag",) + aux.what_to_tag(placeholders))
+        optional_names = [name.strip() for name in self.retrieve_config(
+            'optional_stages', '').split(",")]
+        for name in self.retrieve_config('stages', '').split(","):
+            name = name.strip()
+            if not name:
+                continue
+            command = self.retrieve_config('stage_' + name, None)
+            if command is None:
+                print("There is no stage_{} option, so I cannot run that "
+                      "stage.".format(name), file=sys.stderr, flush=True)
+                continue
+            instruction_list = [placeholders.substitute(part) for
+                                part in shlex.split(command)]
+            stage = ("command", name, instruction_list)
+            if name in optional_names:
+                optional.append(stage)
+            else:
+                required.append(stage)
+        return required, optional
+
+    def append_history(self, podname, linkdate):
+        """
+        Record an entry as already dealt with
+        """
+        if self.use_history:
+            # We write to the database this often to ensure that
+            # downloaded entries count as downloaded.
+            self.history.add(self.name, podname, linkdate)
+
 
 class Placeholders:
-    def __init__(self, feed, entry, link, filename, title, summary):
+    """
+    The values of the placeholders for an entry. Those that take some work to
+    find out are only worked out if a template asks for them, and then only
+    once; those that are the same for every entry of a feed are worked out
+    once per feed.
+    """
+    def __init__(self, feed, entry, link, filename, title):
         self.feed = feed
+        self.entry = entry
         self.link = link
         self.filename = filename
         # self.fullpath = os.path.join(self.directory, self.filename)
         self.title = title.replace("\"", "'")
-        self.filename_title = aux.sanitize(title)
-        try:
-            self.podcasttitle = feed.podcast.title
-        except AttributeError:
-            self.podcasttitle = feed.name
-        try:
-            self.sanitizedsubtitle = aux.html_to_text(
-                feed.podcast.feed.subtitle)
-            if self.sanitizedsubtitle == "":
-                self.sanitizedsubtitle = "No description"
-        except AttributeError:
-            self.sanitizedsubtitle = "No description"
-        self.entrysummary = summary
-        self.filename_podcasttitle = aux.sanitize(self.podcasttitle)
+        self.rawtitle = title
         self.name = feed.name
         self.date = tuple(entry.linkdate)
         self.itunes_episode = entry.get('itunes_episode')
 
+    @cached_property
+    def filename_title(self):
+        return aux.sanitize(self.rawtitle)
+
+    @cached_property
+    def entrysummary(self):
+        try:
+            summary = self.entry.summary  # which many entries don't have
+            with self.feed.trace("html_to_text", entry=self.filename):
+                sanitizedsummary = aux.html_to_text(summary)
+            if sanitizedsummary == "":
+                sanitizedsummary = "No summary available"
+        except Exception:
+            sanitizedsummary = "No summary available"
+        return sanitizedsummary
+
+    @property
+    def podcasttitle(self):
+        return self.feed.podcasttitle
+
+    @property
+    def filename_podcasttitle(self):
+        return self.feed.filename_podcasttitle
+
+    @property
+    def sanitizedsubtitle(self):
+        return self.feed.sanitizedsubtitle
+
+    @cached_property
     def date_string(self):
         date_format = self.feed.retrieve_config("date_format", "%Y-%m-%d")
         return time.strftime(date_format, self.date)
 
+    # The attribute holding the value of each placeholder
+    fields = {"link": "link",
+              "filename": "filename",
+              "directory": "directory",
+              "fullpath": "fullpath",
+              "title": "title",
+              "filename_title": "filename_title",
+              "date": "date_string",
+              "podcasttitle": "podcasttitle",
+              "filename_podcasttitle": "filename_podcasttitle",
+              "name": "name",
+              "subtitle": "sanitizedsubtitle",
+              "entrysummary": "entrysummary",
+              "itunes_episode": "itunes_episode"}
+
+    def __getitem__(self, key):
+        """
+        Return the value of the placeholder {key}
+        """
+        return getattr(self, self.fields[key])
+
     def substitute(self, inputstring):
         """
         Take a string with placeholders, and return the strings with substitutions.
         """
-        newst = inputstring.format(link=self.link,
-                                   filename=self.filename,
-                                   directory=self.directory,
-                                   fullpath=self.fullpath,
-                                   title=self.title,
-                                   filename_title=self.filename_title,
-                                   date=self.date_string(),
-                                   podcasttitle=self.podcasttitle,
-                                   filename_podcasttitle=
-                                   self.filename_podcasttitle,
-                                   name=self.name,
-                                   subtitle=self.sanitizedsubtitle,
-                                   entrysummary=self.entrysummary,
-                                   itunes_episode = self.itunes_episode)
-        return newst
+        return inputstring.format_map(self)
+
+
+class History():
+    """
+    The entries that greg has already dealt with, for every feed, kept in an
+    SQLite database in the data directory. Entries are indexed by feed, link
+    and date, and the latest date of each feed is kept on its own, so neither
+    checking an entry nor finding out where to sync from needs to go through
+    the whole history.
+
+    Older versions of greg kept a text file per feed in the data directory;
+    these are imported the first time they are found, and then renamed with a
+    ".migrated" extension.
+    """
+    def __init__(self, data_dir, feeds):
+        self.data_dir = data_dir
+        self.filename = os.path.join(data_dir, "history.db")
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(self.filename, timeout=60,
+                                          check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript("""
+                PRAGMA journal_mode = WAL;
+                PRAGMA synchronous = NORMAL;
+                CREATE TABLE IF NOT EXISTS history (
+                    feed TEXT NOT NULL,
+                    entrylink TEXT NOT NULL,
+                    linkdate TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS history_entry
+                    ON history (feed, entrylink, linkdate);
+                CREATE TABLE IF NOT EXISTS latest (
+                    feed TEXT PRIMARY KEY,
+                    linkdate TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT);
+                CREATE TABLE IF NOT EXISTS pending (
+                    feed TEXT NOT NULL,
+                    entrylink TEXT NOT NULL,
+                    linkdate TEXT NOT NULL,
+                    PRIMARY KEY (feed, entrylink, linkdate));
+                """)
+        for feed in feeds:
+            self.migrate(feed)
+
+    def migrate(self, feed):
+        """
+        Import the old history file of feed, if there is one
+        """
+        infofile = os.path.join(self.data_dir, feed)
+        if not os.path.isfile(infofile):
+            return
+        entrylinks, linkdates = aux.parse_feed_info(infofile)
+        with self.lock, self.connection:
+            for entrylink, linkdate in zip(entrylinks, linkdates):
+                self.insert(feed, entrylink, linkdate)
+        os.replace(infofile, infofile + ".migrated")
+
+    def insert(self, feed, entrylink, linkdate):
+        linkdate = list(linkdate)
+        self.connection.execute(
+            "INSERT INTO history VALUES (?, ?, ?)",
+            (feed, entrylink, json.dumps(linkdate)))
+        latest = self.latest(feed)
+        if latest is None or linkdate > latest:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO latest VALUES (?, ?)",
+                (feed, json.dumps(linkdate)))
+
+    def add(self, feed, entrylink, linkdate):
+        """
+        Record an entry of feed as already dealt with
+        """
+        with self.lock, self.connection:
+            self.insert(feed, entrylink, linkdate)
+            self.connection.execute(
+                "DELETE FROM pending WHERE feed = ? AND entrylink = ? AND "
+                "linkdate = ?", (feed, entrylink, json.dumps(list(linkdate))))
+
+    def hold(self, feed, entrylink, linkdate):
+        """
+        Note down that an entry of feed is about to be downloaded. Until it is
+        added to the history, sync doesn't go past it (see cutoff), so that if
+        the download fails or is interrupted, the next sync tries it again.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO pending VALUES (?, ?, ?)",
+                (feed, entrylink, json.dumps(list(linkdate))))
+
+    def release(self, feed, oldest):
+        """
+        Stop waiting for the pending entries of feed dated before oldest (the
+        date of the oldest entry the feed still lists), since they can no
+        longer be downloaded
+        """
+        with self.lock, self.connection:
+            rows = self.connection.execute(
+                "SELECT rowid, linkdate FROM pending WHERE feed = ?",
+                (feed,)).fetchall()
+            self.connection.executemany(
+                "DELETE FROM pending WHERE rowid = ?",
+                [(rowid,) for rowid, date in rows
+                 if json.loads(date) < list(oldest)])
+
+    def cutoff(self, feed):
+        """
+        Return the date after which the entries of feed may still need to be
+        downloaded: the latest date in its history, or, if some earlier entry
+        is still pending, a date just before that entry's. Return None if
+        the feed has neither history nor pending entries.
+        """
+        latest = self.latest(feed)
+        with self.lock:
+            pending = [json.loads(row[0]) for row in self.connection.execute(
+                "SELECT linkdate FROM pending WHERE feed = ?", (feed,))]
+        if not pending:
+            return latest
+        # A date cut short sorts before every date that starts with it
+        earliest = min(pending)[:6]
+        return earliest if latest is None or earliest < latest else latest
+
+    def contains(self, feed, entrylink, linkdate):
+        """
+        Check whether an entry of feed has already been dealt with
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM history WHERE feed = ? AND entrylink = ? AND "
+                "linkdate = ? LIMIT 1",
+                (feed, entrylink, json.dumps(list(linkdate)))).fetchone()
+        return row is not None
+
+    def latest(self, feed):
+        """
+        Return the latest date in the history of feed, or None if its history
+        is empty
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT linkdate FROM latest WHERE feed = ?",
+                (feed,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def linkdates(self, feed, count):
+        """
+        Return the dates of the count entries of feed most recently added to
+        the history
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT linkdate FROM history WHERE feed = ? "
+                "ORDER BY rowid DESC LIMIT ?", (feed, count)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def truncate(self, feed, linkdate):
+        """
+        Forget every entry of feed dated on or after linkdate
+        """
+        with self.lock, self.connection:
+            rows = self.connection.execute(
+                "SELECT rowid, linkdate FROM history WHERE feed = ?",
+                (feed,)).fetchall()
+            dates = [(rowid, json.loads(date)) for rowid, date in rows]
+            self.connection.executemany(
+                "DELETE FROM history WHERE rowid = ?",
+                [(rowid,) for rowid, date in dates if date >= linkdate])
+            self.connection.execute("DELETE FROM pending WHERE feed = ?",
+                                    (feed,))
+            remaining = [date for rowid, date in dates if date < linkdate]
+            if remaining:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO latest VALUES (?, ?)",
+                    (feed, json.dumps(max(remaining))))
+            else:
+                self.connection.execute(
+                    "DELETE FROM latest WHERE feed = ?", (feed,))
+
+    def compact(self, feeds):
+        """
+        Tidy up the history of feeds: remove repeated and unreadable entries,
+        recompute the latest date of each feed, and give the space back to
+        the filesystem. Return the number of entries removed.
+        """
+        removed = 0
+        with self.lock:
+            with self.connection:
+                for feed in feeds:
+                    removed += self.compact_feed(feed)
+            self.connection.execute("VACUUM")
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                    ("compacted_at", self.last_rowid()))
+        return removed
+
+    def compact_feed(self, feed):
+        rows = self.connection.execute(
+            "SELECT rowid, entrylink, linkdate FROM history WHERE feed = ? "
+            "ORDER BY rowid", (feed,)).fetchall()
+        seen = set()
+        unwanted = []
+        latest = None
+        for rowid, entrylink, linkdate in rows:
+            try:
+                date = json.loads(linkdate)
+                if not isinstance(date, list):
+                    raise ValueError
+            except ValueError:
+                unwanted.append((rowid,))
+                continue
+            if (entrylink, linkdate) in seen:
+                unwanted.append((rowid,))
+                continue
+            seen.add((entrylink, linkdate))
+            if latest is None or date > latest:
+                latest = date
+        self.connection.executemany("DELETE FROM history WHERE rowid = ?",
+                                    unwanted)
+        if latest is None:
+            self.connection.execute("DELETE FROM latest WHERE feed = ?",
+                                    (feed,))
+        else:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO latest VALUES (?, ?)",
+                (feed, json.dumps(latest)))
+        return len(unwanted)
+
+    def last_rowid(self):
+        row = self.connection.execute(
+            "SELECT max(rowid) FROM history").fetchone()
+        return row[0] or 0
+
+    def needs_compacting(self, threshold):
+        """
+        Check whether more than threshold entries have been added since the
+        last compaction
+        """
+        if threshold <= 0:
+            return False
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'compacted_at'").fetchone()
+            compacted_at = int(row[0]) if row else 0
+            return self.last_rowid() - compacted_at > threshold
+
+    def forget(self, feed):
+        """
+        Forget the whole history of feed
+        """
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM history WHERE feed = ?",
+                                    (feed,))
+            self.connection.execute("DELETE FROM latest WHERE feed = ?",
+                                    (feed,))
+            self.connection.execute("DELETE FROM pending WHERE feed = ?",
+                                    (feed,))
+
+
+class Stats():
+    """
+    How each sync went, feed by feed, kept in an SQLite database in the data
+    directory for keep_stats days: how long fetching the feed took, the HTTP
+    status, the size of the feed, how many entries it had and how many of
+    them were new, how many bytes were downloaded and in how long, and how
+    many things went wrong. The figures are worked out from the spans of the
+    sync (see Tracer).
+    """
+    fields = ["fetch_time", "status", "size", "entries", "new", "downloaded",
+              "download_time", "failures"]
+
+    def __init__(self, data_dir):
+        self.filename = os.path.join(data_dir, "stats.db")
+        self.connection = sqlite3.connect(self.filename, timeout=60)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.executescript("""
+                PRAGMA journal_mode = WAL;
+                PRAGMA synchronous = NORMAL;
+                CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY,
+                    started REAL NOT NULL,
+                    duration REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS feeds (
+                    run INTEGER NOT NULL,
+                    feed TEXT NOT NULL,
+                    fetch_time REAL,
+                    status INTEGER,
+                    size INTEGER,
+                    entries INTEGER,
+                    new INTEGER,
+                    downloaded INTEGER,
+                    download_time REAL,
+                    failures INTEGER);
+                CREATE INDEX IF NOT EXISTS feeds_run ON feeds (run);
+                CREATE INDEX IF NOT EXISTS feeds_feed ON feeds (feed, run);
+                """)
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def summarize(spans):
+        """
+        Work out the figures of each feed from the spans of a sync
+        """
+        feeds = {}
+        for phase, _, duration, _, args in spans:
+            if "feed" not in args:
+                continue
+            figures = feeds.setdefault(args["feed"], dict(
+                fetch_time=None, status=None, size=None, entries=None, new=0,
+                downloaded=0, download_time=0.0, failures=0))
+            failed = Tracer.failed(phase, args)
+            figures["failures"] += failed
+            if phase == "fetch":
+                figures["fetch_time"] = duration
+                figures["status"] = args.get("status")
+                if args.get("status") != 304:
+                    figures["size"] = args.get("bytes")
+            elif phase == "parse":
+                figures["entries"] = args.get("entries")
+            elif phase == "filter":
+                figures["new"] += 1  # every entry not in the history
+            elif phase == "download" and not failed:
+                figures["downloaded"] += args.get("bytes", 0)
+                figures["download_time"] += duration
+        return feeds
+
+    def record(self, started, duration, spans, keep):
+        """
+        Store the figures of a sync, and forget those older than keep days
+        """
+        feeds = self.summarize(spans)
+        with self.connection:
+            run = self.connection.execute(
+                "INSERT INTO runs (started, duration) VALUES (?, ?)",
+                (started, duration)).lastrowid
+            self.connection.executemany(
+                "INSERT INTO feeds (run, feed, {}) VALUES (?, ?, {})".format(
+                    ", ".join(self.fields), ", ".join("?" * len(self.fields))),
+                [[run, feed] + [figures[field] for field in self.fields]
+                 for feed, figures in feeds.items()])
+            old = [row["id"] for row in self.connection.execute(
+                "SELECT id FROM runs WHERE started < ?",
+                (time.time() - keep * 86400,))]
+            self.connection.executemany("DELETE FROM feeds WHERE run = ?",
+                                        [(run,) for run in old])
+            self.connection.executemany("DELETE FROM runs WHERE id = ?",
+                                        [(run,) for run in old])
+
+    def runs(self, since):
+        """
+        Return the start and duration of the syncs since a given time
+        """
+        return self.connection.execute(
+            "SELECT started, duration FROM runs WHERE started >= ? "
+            "ORDER BY started", (since,)).fetchall()
+
+    def rows(self, since):
+        """
+        Return the figures of every feed in every sync since a given time,
+        oldest first
+        """
+        return self.connection.execute(
+            "SELECT feeds.*, runs.started FROM feeds JOIN runs "
+            "ON feeds.run = runs.id WHERE runs.started >= ? "
+            "ORDER BY runs.started", (since,)).fetchall()
+
+    def latest(self, value, condition="1"):
+        """
+        Return, for every feed, the given value (an SQL expression) in the
+        last sync that meets the condition (another one)
+        """
+        return dict(self.connection.execute(
+            "SELECT feed, {0} FROM feeds AS last WHERE {1} AND run = ("
+            "SELECT MAX(run) FROM feeds WHERE feeds.feed = last.feed AND {1})"
+            .format(value, condition)).fetchall())
+
+    def write_prometheus(self, output, names):
+        """
+        Write, in the text format of Prometheus, how the last sync went, and
+        the latest figures of each of the feeds in names
+        """
+        last_run = self.connection.execute(
+            "SELECT started, duration FROM runs ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+        last_success = dict(self.connection.execute(
+            "SELECT feed, MAX(started) FROM feeds JOIN runs "
+            "ON feeds.run = runs.id WHERE failures = 0 GROUP BY feed"
+        ).fetchall())
+        metrics = [
+            ("greg_sync_last_run_timestamp_seconds",
+             "When the last greg sync started.",
+             {None: last_run and last_run["started"]}),
+            ("greg_sync_duration_seconds",
+             "How long the last greg sync took.",
+             {None: last_run and last_run["duration"]}),
+            ("greg_feed_fetch_duration_seconds",
+             "How long fetching the feed took, the last time.",
+             self.latest("fetch_time", "fetch_time IS NOT NULL")),
+            ("greg_feed_http_status",
+             "The HTTP status of the feed, the last time it was fetched.",
+             self.latest("status", "status IS NOT NULL")),
+            ("greg_feed_size_bytes",
+             "The size of the feed, the last time it was fetched in full.",
+             self.latest("size", "size IS NOT NULL")),
+            ("greg_feed_entries",
+             "The number of entries of the feed, the last time it was read.",
+             self.latest("entries", "entries IS NOT NULL")),
+            ("greg_feed_new_entries",
+             "The number of new entries of the feed in its last sync.",
+             self.latest("new")),
+            ("greg_feed_downloaded_bytes",
+             "The bytes downloaded for the feed in its last sync.",
+             self.latest("downloaded")),
+            ("greg_feed_download_throughput_bytes_per_second",
+             "How fast the feed downloaded, the last time it downloaded "
+             "anything.",
+             self.latest("downloaded / download_time", "download_time > 0")),
+            ("greg_feed_failures",
+             "The number of things that went wrong with the feed in its last "
+             "sync.", self.latest("failures")),
+            ("greg_feed_last_success_timestamp_seconds",
+             "When the last sync of the feed that went well started.",
+             last_success)]
+        for name, description, values in metrics:
+            output.write("# HELP {0} {1}\n# TYPE {0} gauge\n".format(
+                name, description))
+            for feed in [None] if None in values else names:
+                if values.get(feed) is None:
+                    continue
+                labels = "" if feed is None else '{{feed="{}"}}'.format(
+                    aux.prometheus_label(feed))
+                output.write("{}{} {}\n".format(name, labels, values[feed]))
+
+
+class FeedCache():
+    """
+    The feeds that greg has fetched lately, with only the bits of them that
+    greg uses, kept as JSON files in the cache directory (one per feed url,
+    named after its hash). Along with the entries, we keep the validators the
+    server sent and a hash of the document, so that we can tell whether the
+    feed has changed. Only the size most recently used feeds are kept.
+
+    The entries listed by 'greg check' are marked as checked, and they are the
+    ones that 'greg download' refers to, until the feed changes.
+    """
+    feed_fields = ["title", "subtitle", "published_parsed", "updated_parsed"]
+    entry_fields = ["title", "link", "links", "summary", "itunes_episode",
+                    "published", "published_parsed", "updated",
+                    "updated_parsed"]
+
+    def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size
+
+    def path(self, url):
+        name = hashlib.sha1(url.encode()).hexdigest()[:20]
+        return os.path.join(self.directory, name + ".json")
+
+    def load(self, url):
+        """
+        Return what we know about the feed at url, or None
+        """
+        path = self.path(url)
+        try:
+            with open(path, 'r') as cachefile:
+                cached = json.load(cachefile)
+            os.utime(path)  # it counts as recently used
+        except (OSError, ValueError):
+            return None
+        return cached if cached.get("url") == url else None
+
+    def save(self, url, podcast, checked=False):
+        """
+        Keep the feed at url, which has just been fetched and parsed
+        """
+        if not checked:
+            # the entries are still the ones listed by 'greg check' if the
+            # feed is just the same
+            previous = self.load(url)
+            checked = bool(previous and previous.get("checked") and
+                           previous["digest"] == podcast.get("digest"))
+        cached = {"url": url, "digest": podcast.get("digest"),
+                  "checked": checked,
+                  "complete": podcast.get("complete", True),
+                  "etag": podcast.get("etag"),
+                  "modified": podcast.get("modified"),
+                  "feed": self.pick(podcast.get("feed", {}), self.feed_fields),
+                  "entries": [self.pick(entry, self.entry_fields) for entry in
+                              podcast.get("entries", [])]}
+        aux.ensure_dir(self.directory)
+        aux.write_atomically(self.path(url),
+                             lambda cachefile: json.dump(cached, cachefile))
+        self.evict()
+
+    @staticmethod
+    def pick(item, fields):
+        """
+        Take the fields we want from a feed or an entry
+        """
+        picked = {}
+        for field in fields:
+            value = item.get(field)
+            if value is not None:
+                picked[field] = list(value) if field.endswith(
+                    "_parsed") else value
+        return picked
+
+    @staticmethod
+    def podcast(cached):
+        """
+        Turn what load returns back into something that looks like what
+        feedparser returns
+        """
+        feedparser = aux.load_feedparser()
+
+        def unpick(picked):
+            item = feedparser.FeedParserDict()
+            for field, value in picked.items():
+                if field.endswith("_parsed"):
+                    value = time.struct_time(value)
+                elif field == "links":
+                    value = [feedparser.FeedParserDict(link) for link in value]
+                item[field] = value
+            return item
+        return feedparser.FeedParserDict(
+            bozo=0, feed=unpick(cached["feed"]), href=cached["url"],
+            entries=[unpick(entry) for entry in cached["entries"]],
+            digest=cached["digest"], complete=cached["complete"],
+            etag=cached["etag"], modified=cached["modified"])
+
+    def evict(self):
+        """
+        Forget the feeds that have been used least recently, so that there are
+        at most self.size of them
+        """
+        try:
+            names = [name for name in os.listdir(self.directory) if
+                     name.endswith(".json")]
+        except FileNotFoundError:
+            return
+        paths = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                paths.append((os.path.getmtime(path), path))
+            except OSError:
+                continue  # someone else has removed it
+        paths.sort(reverse=True)
+        for mtime, path in paths[self.size:]:
+            self.remove(path)
+
+    def forget(self, url):
+        self.remove(self.path(url))
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def remember_last(self, name, url):
+        """
+        Note down the feed that was last checked, for 'greg download'
+        """
+        aux.ensure_dir(self.directory)
+        aux.write_atomically(
+            os.path.join(self.directory, "last"), lambda lastfile: json.dump(
+                {"name": name, "url": url}, lastfile))
+
+    def last(self):
+        """
+        Return the name and url of the feed that was last checked, or None
+        """
+        try:
+            with open(os.path.join(self.directory, "last"), 'r') as lastfile:
+                last = json.load(lastfile)
+        except (OSError, ValueError):
+            return None
+        return last["name"], last["url"]
+
+
+class TokenBucket():
+    """
+    Share out a bandwidth limit, which may change with the time of day (see
+    aux.parse_bandwidth), between any number of downloading threads. The
+    bucket fills up at the current rate, up to a second's worth of bytes, and
+    downloads take their bytes out of it; a download that takes more than
+    there is waits until the bucket has made up for it.
+    """
+    def __init__(self, option, value):
+        self.option = option  # the option that sets the limit
+        self.value = value
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    @cached_property
+    def schedule(self):
+        """
+        The limit, read when it is first needed, so that a mistake in it
+        only gets in the way of the downloads
+        """
+        try:
+            return aux.parse_bandwidth(self.value)
+        except ValueError as error:
+            raise ValueError("your {} option is wrong ({})".format(
+                self.option, error)) from None
+
+    def reserve(self, size):
+        """
+        Take size bytes out of the bucket, and return how many seconds to
+        wait before going on
+        """
+        rate = aux.current_bandwidth(self.schedule)
+        if rate is None:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(rate,
+                              self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            # The bucket can go into debt, so that threads that come later
+            # wait for those that came first
+            self.tokens -= size
+            return max(0, -self.tokens / rate)
+
+
+class DownloadScheduler():
+    """
+    Download enclosures in the background, max_parallel_downloads at a time,
+    but never more than max_connections_per_host from the same host, nor more
+    than max_parallel_handlers with an external download handler, at the same
+    time.
+    """
+    def __init__(self, session):
+        self.workers = max(1, int(session.retrieve_config(
+            'max_parallel_downloads', '1')))
+        self.per_host = max(1, int(session.retrieve_config(
+            'max_connections_per_host', '2')))
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.condition = threading.Condition()
+        self.pending = []  # downloads waiting for a free slot
+        self.running = 0
+        self.hosts = {}  # number of running downloads per host
+        self.handlers = int(session.retrieve_config(
+            'max_parallel_handlers', '0')) or self.workers
+        self.running_handlers = 0  # downloads with an external handler
+        self.failures = []  # (feed, podname) of the downloads that failed
+
+    def submit(self, feed, placeholders, podname, linkdate):
+        """
+        Queue an enclosure for download
+        """
+        host = urlparse(placeholders.link).netloc
+        external = feed.retrieve_config('downloadhandler', 'greg') != 'greg'
+        feed.start_job()
+        with self.condition:
+            # the download runs in the context of whoever queued it, so that
+            # its output goes to the same place (see Daemon)
+            self.pending.append((host, external, feed, placeholders, podname,
+                                 linkdate, contextvars.copy_context()))
+            self.dispatch()
+
+    def dispatch(self):
+        """
+        Start as many pending downloads as the limits allow. Downloads whose
+        host is busy are skipped over, so they don't hold up the rest.
+        """
+        for job in list(self.pending):
+            if self.running >= self.workers:
+                break
+            host, external = job[:2]
+            if self.hosts.get(host, 0) >= self.per_host:
+                continue
+            if external and self.running_handlers >= self.handlers:
+                continue
+            self.pending.remove(job)
+            self.running += 1
+            self.running_handlers += external
+            self.hosts[host] = self.hosts.get(host, 0) + 1
+            self.executor.submit(job[-1].run, self.download, *job[:-1])
+
+    def download(self, host, external, feed, placeholders, podname,
+                 linkdate):
+        try:
+            if feed.session.out_of_time():
+                print("Out of time: {} ({}) will be downloaded in the next "
+                      "sync.".format(podname, feed.name), file=sys.stderr,
+                      flush=True)
+                feed.forget_validators()
+                return
+            feed.download_enclosure(placeholders, podname, linkdate)
+        except Exception as exception:
+            print("I could not download {} ({}): {}".format(
+                podname, feed.name, exception), file=sys.stderr, flush=True)
+            feed.forget_validators()
+            with self.condition:
+                self.failures.append((feed.name, podname))
+        finally:
+            feed.finish_job()
+            with self.condition:
+                self.running -= 1
+                self.running_handlers -= external
+                self.hosts[host] -= 1
+                self.dispatch()
+                self.condition.notify_all()
+
+    def wait(self):
+        """
+        Wait until every queued download is done
+        """
+        try:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: not self.pending and not self.running)
+        except KeyboardInterrupt:
+            with self.condition:
+                self.pending.clear()
+            raise
+        finally:
+            self.executor.shutdown(wait=True)
+
+
+class PostProcessor():
+    """
+    Do the post-download stages of each enclosure (see
+    Feed.post_download_stages) on a pool of max_parallel_stages worker
+    processes, so that tagging and such don't hold up the downloads. An entry
+    is recorded in the history once its required stages are done; its
+    optional stages are done after that.
+    """
+    def __init__(self, session):
+        self.workers = int(session.retrieve_config(
+            'max_parallel_stages', str(os.cpu_count() or 1)))
+        self.executor = None  # started when the first stage comes along
+        self.condition = threading.Condition()
+        self.running = 0
+        # (feed, podname) of the entries whose required stages failed
+        self.failures = []
+
+    def submit(self, feed, placeholders, podname, linkdate):
+        """
+        Queue the post-download stages of an enclosure. If it has no required
+        stages, it is recorded in the history straight away.
+        """
+        required, optional = feed.post_download_stages(placeholders)
+        if self.workers < 1:
+            # No worker processes: everything is done on the spot
+            try:
+                self.record(feed, podname, aux.run_stages(required))
+            except Exception as exception:
+                self.record(feed, podname, getattr(exception, "timings", []))
+                self.discard(placeholders.fullpath)
+                raise
+            feed.append_history(podname, linkdate)
+            try:
+                self.record(feed, podname, aux.run_stages(optional))
+            except Exception as exception:
+                self.record(feed, podname, getattr(exception, "timings", []))
+                self.report(feed, podname, exception)
+        elif required:
+            feed.start_job()
+            self.start(required, self.finish, feed, podname, linkdate,
+                       optional, placeholders.fullpath)
+        else:
+            feed.append_history(podname, linkdate)
+            if optional:
+                self.start(optional, self.finish, feed, podname)
+
+    def start(self, stages, callback, *args):
+        """
+        Run stages on a worker process, and then callback(future, *args)
+        """
+        # the callback runs in the context of whoever queued the stages, so
+        # that its output goes to the same place (see Daemon)
+        context = contextvars.copy_context()
+        with self.condition:
+            if self.executor is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # Worker processes are spawned afresh rather than forked,
+                # since greg may have other threads running
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"))
+            future = self.executor.submit(aux.run_stages, stages)
+            self.running += 1
+        future.add_done_callback(
+            lambda future: context.run(callback, future, *args))
+
+    def finish(self, future, feed, podname, linkdate=None, optional=(),
+               fullpath=None):
+        """
+        Record an entry in the history once its required stages are done,
+        and queue its optional stages. For optional stages (no linkdate),
+        just report how they went.
+        """
+        try:
+            exception = future.exception()
+            if exception is not None:
+                # the failed stage is traced too (see aux.run_stages)
+                self.record(feed, podname, getattr(exception, "timings", []))
+                self.report(feed, podname, exception)
+                if linkdate is not None:
+                    # the entry will be tried again in the next sync
+                    self.fail(feed, podname, fullpath)
+                return
+            self.record(feed, podname, future.result())
+            if linkdate is not None:
+                feed.append_history(podname, linkdate)
+            if optional:
+                self.start(optional, self.finish, feed, podname)
+        except Exception as exception:  # cancelled, or shutting down
+            self.report(feed, podname, exception)
+            if linkdate is not None:
+                self.fail(feed, podname, fullpath)
+        finally:
+            if linkdate is not None:
+                feed.finish_job()
+            with self.condition:
+                self.running -= 1
+                self.condition.notify_all()
+
+    @staticmethod
+    def record(feed, podname, timings):
+        """
+        Hand the timings of the stages (see aux.run_stages) to the tracer
+        """
+        for name, process, start, duration, outcome in timings:
+            feed.session.tracer.add(
+                "tag" if name == "tag" else "stage " + name, start, duration,
+                thread=process, feed=feed.name, entry=podname,
+                outcome=outcome)
+
+    def fail(self, feed, podname, fullpath):
+        """
+        Note that the required stages of an entry failed. The entry will be
+        tried again in the next sync.
+        """
+        self.discard(fullpath)
+        feed.forget_validators()
+        with self.condition:
+            self.failures.append((feed.name, podname))
+
+    @staticmethod
+    def discard(fullpath):
+        """
+        Remove an enclosure whose required stages failed, so that the next
+        sync downloads it afresh under the same name, rather than next to it
+        """
+        if fullpath is None:
+            return
+        try:
+            os.remove(fullpath)
+        except OSError:
+            pass  # an external handler or a stage may have put it elsewhere
+
+    @staticmethod
+    def report(feed, podname, exception):
+        print("I could not process {} ({}): {}".format(
+            podname, feed.name, exception), file=sys.stderr, flush=True)
+
+    def wait(self):
+        """
+        Wait until every queued stage is done
+        """
+        try:
+            with self.condition:
+                self.condition.wait_for(lambda: not self.running)
+        finally:
+            with self.condition:
+                executor, self.executor = self.executor, None
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+
+class GroupedOutput():
+    """
+    Group the output of several feeds processed at the same time. Whatever is
+    printed inside group() is kept aside, and printed in one go when the group
+    is done. The output is told apart by output_sink, which follows the
+    context of each thread, so sys.stdout and sys.stderr are never swapped
+    while other commands may be printing (see Daemon).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.replaced = None  # the streams we stand in for, if any
+
+    def __enter__(self):
+        if not isinstance(sys.stdout, _ForwardedStream):
+            # Not in the daemon, so there is only this command running
+            self.replaced = sys.stdout, sys.stderr
+            sys.stdout = _ForwardedStream("stdout", sys.stdout)
+            sys.stderr = _ForwardedStream("stderr", sys.stderr)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.replaced is not None:
+            sys.stdout, sys.stderr = self.replaced
+            self.replaced = None
+
+    @contextmanager
+    def group(self):
+        """
+        Collect the output of the current context until the block is done.
+        Whatever is printed in it after that (by a download that was queued
+        in it, say) goes straight through.
+        """
+        outer = output_sink.get()
+        streams = {"stdout": _ForwardedStream.underlying(sys.stdout),
+                   "stderr": _ForwardedStream.underlying(sys.stderr)}
+        chunks = []
+
+        def forward(stream, text):
+            if outer is None:
+                streams[stream].write(text)
+            else:
+                outer(stream, text)
+
+        def sink(stream, text):
+            with self.lock:
+                if chunks is not None:
+                    chunks.append((stream, text))
+                    return
+            forward(stream, text)
+
+        token = output_sink.set(sink)
+        try:
+            yield
+        finally:
+            output_sink.reset(token)
+            with self.lock:
+                grouped, chunks = chunks, None
+                for stream, text in grouped:
+                    forward(stream, text)
+                if outer is None:
+                    for stream in streams.values():
+                        stream.flush()
+
+    def run(self, function, *args):
+        """
+        Call function(*args), grouping its output
+        """
+        with self.group():
+            return function(*args)
+
+
+class Tracer():
+    """
+    Time the phases of a command (fetching and parsing each feed, filtering,
+    downloading and tagging each entry, and so on) as spans, each with the
+    feed and entry it belongs to, the bytes it transferred and its outcome.
+    With --trace, the spans are written to a file that Chrome's about:tracing
+    and Perfetto can show, and a summary is printed at the end; with
+    --events, each span is written to stderr as a line of JSON as soon as it
+    is done. The spans of every sync are also summed up in Stats, unless
+    keep_stats is 0; otherwise, nothing is recorded.
+    """
+    def __init__(self, tracefile=None, events=False, keep=False):
+        self.tracefile = tracefile
+        self.events = events
+        # keep says to record the spans anyway, for the statistics (see Stats)
+        self.enabled = bool(tracefile or events or keep)
+        # Events go out as soon as they happen, not with the output that
+        # GroupedOutput keeps aside
+        self.stream = _ForwardedStream.underlying(sys.stderr)
+        self.sink = output_sink.get()  # in the daemon, see Daemon
+        self.lock = threading.Lock()
+        self.spans = []
+        self.started = time.time()
+
+    @contextmanager
+    def span(self, phase, **args):
+        """
+        Time the block as a span of the given phase. The block gets the
+        dictionary of arguments of the span, where it can note down bytes,
+        outcome or anything else.
+        """
+        if not self.enabled:
+            yield args
+            return
+        start = time.time()
+        args.setdefault("outcome", "ok")
+        try:
+            yield args
+        except BaseException as exception:
+            args["outcome"] = type(exception).__name__
+            raise
+        finally:
+            self.add(phase, start, time.time() - start, **args)
+
+    def add(self, phase, start, duration, thread=None, **args):
+        """
+        Record a span that has been timed elsewhere (thread identifies the
+        thread or process that did the work, if it wasn't the current one)
+        """
+        if not self.enabled:
+            return
+        thread = thread or threading.get_ident()
+        with self.lock:
+            self.spans.append((phase, start, duration, thread, args))
+            if self.events:
+                event = {"time": round(start + duration, 6), "phase": phase,
+                         "duration": round(duration, 6)}
+                event.update(args)
+                line = json.dumps(event, default=str) + "\n"
+                if self.sink is None:
+                    self.stream.write(line)
+                    self.stream.flush()
+                else:
+                    self.sink("stderr", line)
+
+    def recorded(self):
+        """
+        Return the spans recorded so far, as (phase, start, duration, thread,
+        args) tuples
+        """
+        with self.lock:
+            return list(self.spans)
+
+    @staticmethod
+    def failed(phase, args):
+        """
+        Tell whether a span (given its phase and arguments) was a failure of
+        the sync: a fetch, a download or a post-download stage that went
+        wrong. Other phases may end in an exception in the normal course of
+        things (a feed without a subtitle, say).
+        """
+        if phase not in ("fetch", "download", "tag") and not phase.startswith(
+                "stage "):
+            return False
+        return args.get("outcome") not in ("ok", "not modified", "unchanged")
+
+    def finish(self):
+        """
+        Write the trace file and print the summary, if so asked
+        """
+        if not self.tracefile:
+            return
+        spans = self.recorded()
+        events = [{"name": phase, "cat": "greg", "ph": "X", "pid": os.getpid(),
+                   "tid": thread,
+                   "ts": round((start - self.started) * 1e6),
+                   "dur": round(duration * 1e6), "args": args}
+                  for phase, start, duration, thread, args in spans]
+        with open(self.tracefile, "w") as tracefile:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"},
+                      tracefile, default=str)
+        self.summarize(spans)
+
+    @classmethod
+    def summarize(cls, spans):
+        """
+        Print, for every phase, how many spans there were, how long they took
+        and how many bytes they transferred
+        """
+        phases = {}
+        for phase, _, duration, _, args in spans:
+            durations, sizes, failures = phases.setdefault(phase, ([], [], []))
+            durations.append(duration)
+            sizes.append(args.get("bytes", 0))
+            failures.append(cls.failed(phase, args))
+        print("{:<16}{:>7}{:>11}{:>11}{:>11}{:>12}{:>9}".format(
+            "phase", "count", "total (s)", "mean (ms)", "max (ms)", "bytes",
+            "failed"))
+        for phase, (durations, sizes, failures) in sorted(
+                phases.items(), key=lambda item: -sum(item[1][0])):
+            print("{:<16}{:>7}{:>11.3f}{:>11.1f}{:>11.1f}{:>12}{:>9}".format(
+                phase, len(durations), sum(durations),
+                sum(durations) / len(durations) * 1000,
+                max(durations) * 1000, sum(sizes), sum(failures)))
+
+
+class Daemon():
+    """
+    Keep greg running: every daemon_tick seconds, sync the feeds that are due,
+    and meanwhile run the commands that other greg processes hand over through
+    a Unix socket in the data directory. The commands share the history
+    database, the HTTP connections, the config and the feeds of the daemon's
+    own session; the config and the feeds are only read again from disk when
+    their files change.
+    """
+    def __init__(self, session, commands):
+        self.session = session
+        self.commands = commands  # names of commands, and what runs them
+        self.socketpath = self.socket_path(session.data_dir)
+
+    @staticmethod
+    def socket_path(data_dir):
+        return os.path.join(data_dir, "greg.sock")
+
+    def run(self):
+        """
+        Serve until interrupted (by Ctrl-C or SIGTERM)
+        """
+        session = self.session
+        with open(os.path.join(session.data_dir, "daemon.lock"),
+                  'a') as lockfile:
+            if not aux.lock(lockfile, blocking=False):
+                sys.exit("There is a greg daemon running already.")
+            if os.path.exists(self.socketpath):
+                os.remove(self.socketpath)  # left by a daemon that crashed
+            server = socketserver.ThreadingUnixStreamServer(
+                self.socketpath, _DaemonRequestHandler)
+            server.daemon_threads = True
+            server.greg_daemon = self
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout = _ForwardedStream("stdout", stdout)
+            sys.stderr = _ForwardedStream("stderr", stderr)
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            tick = float(session.retrieve_config('daemon_tick', '60'))
+            args = {key: session.args.get(key) for key in
+                    ["configfile", "datadirectory"]}
+            args.update(names=["all"], due=True, shard=None)
+            try:
+                while True:
+                    self.run_command("sync", args)
+                    time.sleep(tick)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.shutdown()
+                server.server_close()
+                os.remove(self.socketpath)
+                sys.stdout, sys.stderr = stdout, stderr
+
+    def run_command(self, name, args):
+        """
+        Run a command, and return its exit status
+        """
+        try:
+            self.commands[name](args)
+        except SystemExit as exit:
+            if isinstance(exit.code, str):
+                print(exit.code, file=sys.stderr, flush=True)
+                return 1
+            return exit.code or 0
+        except Exception:
+            traceback.print_exc()
+            return 1
+        return 0
+
+
+class _DaemonRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Run a command sent to the daemon. The request is a line of JSON with the
+    name of the command and its arguments; the answer is a line of JSON for
+    every piece of output, and a last one with the exit status.
+    """
+    def handle(self):
+        daemon = self.server.greg_daemon
+        lock = threading.Lock()
+
+        def send(message):
+            with lock:
+                try:
+                    self.wfile.write(json.dumps(message).encode() + b"\n")
+                    self.wfile.flush()
+                except OSError:
+                    pass  # the client has gone away; we carry on regardless
+
+        request = json.loads(self.rfile.readline())
+        if request.get("command") not in daemon.commands:
+            send({"stream": "stderr", "text": "The greg daemon cannot run "
+                  "{}.\n".format(request.get("command"))})
+            send({"exit": 1})
+            return
+        token = output_sink.set(
+            lambda stream, text: send({"stream": stream, "text": text}))
+        try:
+            status = daemon.run_command(request["command"], request["args"])
+        finally:
+            output_sink.reset(token)
+        send({"exit": status})
+
+
+class _ForwardedStream():
+    """
+    Stand in for sys.stdout or sys.stderr, sending whatever is printed to the
+    output_sink of the context, if there is one: in the daemon, to the greg
+    process that asked for the command (see Daemon), and in GroupedOutput, to
+    the output kept aside for a feed
+    """
+    def __init__(self, name, stream):
+        self.name = name
+        self.stream = stream
+
+    @staticmethod
+    def underlying(stream):
+        """
+        The stream that a _ForwardedStream stands in for, or stream itself
+        """
+        if isinstance(stream, _ForwardedStream):
+            return stream.stream
+        return stream
+
+    def write(self, text):
+        sink = output_sink.get()
+        if sink is None:
+            return self.stream.write(text)
+        sink(self.name, text)
+        return len(text)
+
+    def flush(self):
+        if output_sink.get() is None:
+            self.stream.flush()
+
+    def __getattr__(self, attribute):
+        return getattr(self.stream, attribute)
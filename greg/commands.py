@@ -17,14 +17,28 @@
 """
 Defines the functions corresponding to each of the subcommands
 """
-import json
+import contextvars
+import operator
 import os.path
-import pickle
 import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import URLError
 
 import greg.classes as c
 import greg.aux_functions as aux
 
+warm_session = None  # the session kept by the daemon, see daemon()
+
+
+def open_session(args):
+    """
+    Start the session of a command. In the daemon, it shares the history
+    database, HTTP connections, config and feeds of the daemon's own session.
+    """
+    return c.Session(args, shared=warm_session)
+
 
 def retrieveglobalconf(args):
     """
@@ -37,7 +51,7 @@ def add(args):
     """
     Add a new feed
     """
-    session = c.Session(args)
+    session = open_session(args)
     if args["name"] in session.feeds.sections():
         sys.exit("You already have a feed with that name.")
     if args["name"] in ["all", "DEFAULT"]:
@@ -48,63 +62,51 @@ def add(args):
     for key, value in args.items():
         if value is not None and key != "func" and key != "name":
             entry[key] = value
-    session.feeds[args["name"]] = entry
-    with open(session.data_filename, 'w') as configfile:
-        session.feeds.write(configfile)
+    session.add_feed(args["name"], entry)
+    session.save_feeds()
 
 
 def edit(args):  # Edits the information associated with a certain feed
-    session = c.Session(args)
-    feed_info = os.path.join(session.data_dir, args["name"])
+    session = open_session(args)
     if not args["name"] in session.feeds:
         sys.exit("You don't have a feed with that name.")
     for key, value in args.items():
         if value is not None and key == "url":
-            session.feeds[args["name"]][key] = str(value)
-            with open(session.data_filename, 'w') as configfile:
-                session.feeds.write(configfile)
+            session.set_feed_option(args["name"], key, str(value))
+            # the stored ETag and Last-Modified belong to the old url
+            session.set_feed_option(args["name"], "etag", None)
+            session.set_feed_option(args["name"], "modified", None)
+            session.set_feed_option(args["name"], "digest", None)
         if value is not None and key == "downloadfrom":
             try:
                 dateinfo = (session.feeds[
                     args["name"]]["date_info"] == "not available")
             except KeyError:
-                session.feeds[args["name"]]["date_info"] = "available"
-                # provisionally!
-                with open(session.data_filename, 'w') as configfile:
-                    session.feeds.write(configfile)
+                session.set_feed_option(args["name"], "date_info",
+                                        "available")  # provisionally!
                 dateinfo = False  # provisionally
             if dateinfo:
                 print(("{} has no date information that I can use."
                        "Using --downloadfrom might not have the"
                        "results that you expect.").
                       format(args["name"]), file=sys.stderr, flush=True)
-            # A dummy entry with the new downloadfrom date.
-            try:
-                # Remove from the feed file all entries
-                # after or equal to downloadfrom, then append line
-                with open(feed_info, 'r') as previous:
-                    previouslist = previous.readlines()
-                    current = [aline for aline in previouslist if value >
-                               aux.get_date(aline)]
-                with open(feed_info, 'w') as currentfile:
-                    currentfile.writelines(current)
-                with open(feed_info, 'a') as currentfile:
-                    json.dump({'entrylink': "added by the edit command",
-                        'linkdate': value}, currentfile)
-                    currentfile.write('\n')
-            except FileNotFoundError:
-                # Write the file with a dummy entry with the right date
-                with open(feed_info, 'w') as currentfile:
-                    json.dump({'entrylink': "added by the edit command",
-                        'linkdate': value}, currentfile)
-                    currentfile.write('\n')
+            # Entries the feed has not changed may now be needed again
+            session.set_feed_option(args["name"], "etag", None)
+            session.set_feed_option(args["name"], "modified", None)
+            session.set_feed_option(args["name"], "digest", None)
+            # Remove from the history all entries after or equal to
+            # downloadfrom, then add a dummy entry with the new date.
+            session.history.truncate(args["name"], value)
+            session.history.add(args["name"], "added by the edit command",
+                                value)
+    session.save_feeds()
 
 
 def remove(args):
     """
     Remove the feed given in <args>
     """
-    session = c.Session(args)
+    session = open_session(args)
     if not args["name"] in session.feeds:
         sys.exit("You don't have a feed with that name.")
     if not args['force']:
@@ -116,20 +118,17 @@ def remove(args):
     if reply != "y" and reply != "Y":
         return 0
     else:
-        session.feeds.remove_section(args["name"])
-        with open(session.data_filename, 'w') as configfile:
-            session.feeds.write(configfile)
-        try:
-            os.remove(os.path.join(session.data_dir, args["name"]))
-        except FileNotFoundError:
-            pass
+        session.cache.forget(session.feeds[args["name"]]["url"])
+        session.remove_feed(args["name"])
+        session.save_feeds()
+        session.history.forget(args["name"])
 
 
 def info(args):
     """
     Provide information of a number of feeds
     """
-    session = c.Session(args)
+    session = open_session(args)
     if "all" in args["names"]:
         feeds = session.list_feeds()
     else:
@@ -138,8 +137,25 @@ def info(args):
         aux.pretty_print(session, feed)
 
 
+def compact(args):
+    """
+    Implement the 'greg compact' command
+    """
+    session = open_session(args)
+    if "all" in args["names"]:
+        feeds = session.list_feeds()
+    else:
+        feeds = [name for name in args["names"] if name in session.feeds]
+        for name in set(args["names"]) - set(feeds):
+            print("You don't have a feed called {}.".format(name),
+                  file=sys.stderr, flush=True)
+    removed = session.history.compact(feeds)
+    print("Removed {} repeated or unreadable entries from the history."
+          .format(removed))
+
+
 def list_for_user(args):
-    session = c.Session(args)
+    session = open_session(args)
     for feed in session.list_feeds():
         print(feed)
     print()
@@ -149,10 +165,24 @@ def sync(args):
     """
     Implement the 'greg sync' command
     """
-    import operator
-    session = c.Session(args)
+    session = open_session(args)
+    started = time.time()
+    session.start_deadline()
     if "all" in args["names"]:
-        targetfeeds = session.list_feeds()
+        targetfeeds = []
+        for name in session.list_feeds():
+            # Feeds that keep failing are left alone for a while, unless
+            # they are asked for by name
+            skip_until = session.suspended_until(name)
+            if skip_until and args["due"]:
+                continue  # quietly, or the daemon would say so every tick
+            elif skip_until:
+                print("{} has failed too many times in a row. I won't try it "
+                      "again until {}.".format(name, time.strftime(
+                          "%d %b %Y %H:%M", time.localtime(skip_until))),
+                      file=sys.stderr, flush=True)
+            else:
+                targetfeeds.append(name)
     else:
         targetfeeds = []
         for name in args["names"]:
@@ -161,17 +191,104 @@ def sync(args):
                       .format(name), file=sys.stderr, flush=True)
             else:
                 targetfeeds.append(name)
-    for target in targetfeeds:
-        feed = c.Feed(session, target, None)
-        if not feed.wentwrong:
+    if args["shard"]:
+        # Several greg processes can split the feeds between them
+        number, total = args["shard"]
+        targetfeeds = [target for target in targetfeeds if
+                       zlib.crc32(target.encode()) % total == number - 1]
+    if args["due"]:
+        # Only fetch the feeds that are likely to have something new
+        targetfeeds = [target for target in targetfeeds if
+                       session.is_due(target)]
+    session.scheduler = c.DownloadScheduler(session)
+    try:
+        sync_feeds(session, targetfeeds)
+    finally:
+        try:
+            wait_for_downloads(session)
+        finally:
+            # Whatever went wrong above, the feeds still locked are unlocked,
+            # and what was done so far is saved
             try:
-                title = feed.podcast.target.title
-            except AttributeError:
-                title = target
-            print("Checking", title, end="...\n")
-            currentdate, stop = feed.how_many()
-            entrycounter = 0
-            entries_to_download = feed.podcast.entries
+                session.release_feeds()
+            finally:
+                session.save_feeds()
+            session.tracer.finish()
+            try:
+                session.record_stats(started)
+            except Exception as error:
+                # not worth hiding whatever else may have gone wrong for
+                print("I could not record the statistics of this sync: {}"
+                      .format(error), file=sys.stderr, flush=True)
+    threshold = int(session.retrieve_config('compact_threshold', '1000'))
+    if session.history.needs_compacting(threshold):
+        session.history.compact(session.list_feeds())
+
+
+def wait_for_downloads(session):
+    """
+    Wait until the queued downloads, and their post-download stages, are done
+    """
+    try:
+        session.scheduler.wait()
+    finally:
+        session.postprocessor.wait()
+
+
+def sync_feeds(session, targetfeeds):
+    """
+    Sync the target feeds, several at a time if so configured
+    """
+    jobs = int(session.retrieve_config('max_parallel_feeds', '1'))
+    if jobs > 1 and len(targetfeeds) > 1:
+        # Feeds are fetched and parsed on a pool of threads. Each feed is
+        # handled by a single thread, and its output is printed in one go.
+        with c.GroupedOutput() as output, ThreadPoolExecutor(
+                max_workers=jobs) as executor:
+            futures = [executor.submit(contextvars.copy_context().run,
+                                       output.run, sync_feed, session, target)
+                       for target in targetfeeds]
+            for future in futures:
+                future.result()
+    else:
+        for target in targetfeeds:
+            sync_feed(session, target)
+
+
+def sync_feed(session, target):
+    """
+    Sync a single feed
+    """
+    if session.out_of_time():
+        print("Out of time: {} will be synced next time.".format(target),
+              file=sys.stderr, flush=True)
+        return
+    if not session.lock_feed(target):
+        print("{} is being synced by another greg process. Skipping it."
+              .format(target), file=sys.stderr, flush=True)
+        return
+    try:
+        feed = c.Feed(session, target, None)
+    except BaseException:
+        session.release_feed(target)
+        raise
+    if feed.wentwrong:
+        session.record_failure(target)
+    else:
+        session.record_success(target)
+        feed.record_schedule()
+    if feed.notmodified:
+        print("{} has not changed since the last sync".format(target))
+    elif not feed.wentwrong:
+        try:
+            title = feed.podcast.target.title
+        except AttributeError:
+            title = target
+        print("Checking", title, end="...\n")
+        currentdate, stop = feed.how_many()
+        entrycounter = 0
+        entries_to_download = feed.podcast.entries
+        with feed.trace("sort"):
             for entry in entries_to_download:
                 feed.fix_linkdate(entry)
             # Sort entries_to_download, but only if you want to download as
@@ -179,24 +296,34 @@ def sync(args):
             if stop >= len(entries_to_download):
                 entries_to_download.sort(key=operator.attrgetter("linkdate"),
                                          reverse=False)
-            for entry in entries_to_download:
-                if entry.linkdate > currentdate:
-                    downloaded = feed.download_entry(entry)
-                    entrycounter += downloaded
-                if entrycounter >= stop:
-                    break
-            print("Done")
-        else:
-            msg = ''.join(["I cannot sync ", target, " just now: ",
-                feed.wentwrong])
-            print(msg, file=sys.stderr, flush=True)
+        for entry in entries_to_download:
+            if entry.linkdate > currentdate:
+                downloaded = feed.download_entry(entry)
+                entrycounter += downloaded
+            if entrycounter >= stop:
+                break
+        if feed.podcast.get("complete", True) and entries_to_download:
+            # Pending entries that have dropped off the feed can't be tried
+            # again any more
+            feed.history.release(target, min(
+                entry.linkdate for entry in entries_to_download))
+        # The validators are saved once the downloads are done, if they all
+        # went well, and then the feed is unlocked
+        feed.finish_job()
+        print("Done")
+    else:
+        msg = ''.join(["I cannot sync ", target, " just now: ",
+            feed.wentwrong])
+        print(msg, file=sys.stderr, flush=True)
+    if feed.notmodified or feed.wentwrong:
+        session.release_feed(target)  # there is nothing left to do
 
 
 def check(args):
     """
     Implement the 'greg check' command
     """
-    session = c.Session(args)
+    session = open_session(args)
     if str(args["url"]) != 'None':
         url = args["url"]
         name = "DEFAULT"
@@ -206,7 +333,17 @@ def check(args):
             name = args["feed"]
         except KeyError:
             sys.exit("You don't appear to have a feed with that name.")
-    podcast = aux.parse_podcast(url)
+    cached = session.cache.load(url)
+    if cached and cached["complete"]:
+        # If the feed hasn't changed, we already have all its entries
+        podcast = aux.parse_podcast(
+            url, cached["etag"], cached["modified"], http=session.http,
+            timeout=session.timeout, digest=cached["digest"])
+        if podcast.get("status") == 304 or podcast.get("unchanged"):
+            podcast = session.cache.podcast(cached)
+    else:
+        podcast = aux.parse_podcast(url, http=session.http,
+                                    timeout=session.timeout)
     for entry in enumerate(podcast.entries):
         listentry = list(entry)
         print(listentry[0], end=": ")
@@ -219,37 +356,149 @@ def check(args):
         except:
             print("", end=")")
         print()
-    dumpfilename = os.path.join(session.data_dir, 'feeddump')
-    with open(dumpfilename, mode='wb') as dumpfile:
-        dump = [name, podcast]
-        pickle.dump(dump, dumpfile)
+    if not isinstance(podcast.get("bozo_exception"), URLError):
+        session.cache.save(url, podcast, checked=True)
+        session.cache.remember_last(name, url)
 
 
 def download(args):
     """
     Implement the 'greg download' command
     """
-    session = c.Session(args)
+    session = open_session(args)
     issues = aux.parse_for_download(args)
     if issues == ['']:
         sys.exit(
             "You need to give a list of issues, of the form ""a, b-c, d...""")
-    dumpfilename = os.path.join(session.data_dir, 'feeddump')
-    if not os.path.isfile(dumpfilename):
+    if args["feed"]:
+        try:
+            name, url = args["feed"], session.feeds[args["feed"]]["url"]
+        except KeyError:
+            sys.exit("You don't appear to have a feed with that name.")
+    else:
+        name, url = session.cache.last() or (None, None)
+    cached = url and session.cache.load(url)
+    if not cached or not cached.get("checked"):
+        # The entries of the feed are not there, or they have changed since
+        # they were listed
         sys.exit(
             ("You need to run ""greg check"
              "<feed>"" before using ""greg download""."))
-    with open(dumpfilename, mode='rb') as dumpfile:
-        dump = pickle.load(dumpfile)
+    podcast = session.cache.podcast(cached)
     try:
-        feed = c.Feed(session, dump[0], dump[1])
+        feed = c.Feed(session, name, podcast)
     except Exception:
         sys.exit((
             "... something went wrong."
             "Are you sure your last ""greg check"" went well?"))
-    for number in issues:
-        entry = dump[1].entries[eval(number)]
-        feed.info = []
-        feed.entrylinks = []
-        feed.fix_linkdate(entry)
-        feed.download_entry(entry)
+    session.scheduler = c.DownloadScheduler(session)
+    try:
+        for number in issues:
+            entry = podcast.entries[eval(number)]
+            feed.use_history = False
+            feed.fix_linkdate(entry)
+            feed.download_entry(entry)
+    finally:
+        try:
+            wait_for_downloads(session)
+        finally:
+            session.save_feeds()
+    failures = (session.scheduler.failures +
+                session.postprocessor.failures)
+    if failures:
+        sys.exit("I could not download {} of the issues you asked for."
+                 .format(len(failures)))
+
+
+def stats(args):
+    """
+    Implement the 'greg stats' command
+    """
+    session = open_session(args)
+    since = time.time() - args["days"] * 86400
+    stats = c.Stats(session.data_dir)
+    try:
+        runs = stats.runs(since)
+        rows = stats.rows(since)
+    finally:
+        stats.close()
+    if "all" not in args["names"]:
+        rows = [row for row in rows if row["feed"] in args["names"]]
+    if not runs:
+        print("No syncs have been recorded in the last {} days.".format(
+            args["days"]))
+        return
+    durations = [run["duration"] for run in runs]
+    print("{} syncs since {}, taking {:.1f} s (median), {:.1f} s (90%), "
+          "{:.1f} s (longest).".format(
+              len(runs), time.strftime("%d %b %Y %H:%M", time.localtime(
+                  runs[0]["started"])), aux.percentile(durations, 0.5),
+              aux.percentile(durations, 0.9), max(durations)))
+    print()
+    figures = [
+        ("fetch time (s)", [row["fetch_time"] for row in rows], 1),
+        ("feed size (KB)", [row["size"] for row in rows], 2**-10),
+        ("new entries", [row["new"] for row in rows], 1),
+        ("download (MB/s)", [row["downloaded"] / row["download_time"] for row
+                             in rows if row["download_time"]], 2**-20)]
+    print("{:<18}{:>10}{:>10}{:>10}{:>10}".format("", "50%", "90%", "99%",
+                                                 "count"))
+    for name, values, scale in figures:
+        values = [value for value in values if value is not None]
+        if values:
+            print("{:<18}{:>10.3f}{:>10.3f}{:>10.3f}{:>10}".format(
+                name, *[aux.percentile(values, fraction) * scale for fraction
+                        in [0.5, 0.9, 0.99]], len(values)))
+    feeds = {}
+    for row in rows:
+        feeds.setdefault(row["feed"], []).append(row)
+    slowest = sorted(
+        ((aux.percentile([row["fetch_time"] for row in feedrows], 0.5), name)
+         for name, feedrows in feeds.items()),
+        key=lambda item: -(item[0] or 0))[:args["top"]]
+    if slowest:
+        print()
+        print("Slowest feeds (median fetch time):")
+        for median, name in slowest:
+            if median is not None:
+                print("    {:<30}{:>8.3f} s".format(name, median))
+    failing = sorted(((sum(row["failures"] > 0 for row in feedrows), name)
+                      for name, feedrows in feeds.items()), reverse=True)
+    failing = [(count, name) for count, name in failing if count]
+    if failing:
+        print()
+        print("Failing feeds:")
+        for count, name in failing[:args["top"]]:
+            last = [row for row in feeds[name] if row["failures"]][-1]
+            print("    {:<30}failed in {} of {} syncs, last on {}{}".format(
+                name, count, len(feeds[name]), time.strftime(
+                    "%d %b %Y %H:%M", time.localtime(last["started"])),
+                " (HTTP {})".format(last["status"]) if last["status"] and
+                last["status"] >= 400 else ""))
+
+
+def daemon(args):
+    """
+    Implement the 'greg daemon' command
+    """
+    global warm_session
+    warm_session = c.Session(args)
+    c.Daemon(warm_session, {"sync": sync, "info": info,
+                            "list": list_for_user}).run()
+
+
+def forward(args):
+    """
+    Hand a command over to the greg daemon, if there is one running for our
+    data directory. Return its exit status, or None if there is no daemon and
+    we have to run the command ourselves.
+    """
+    names = {sync: "sync", info: "info", list_for_user: "list"}
+    if args["func"] not in names:
+        return None
+    session = c.Session(args)
+    socketpath = c.Daemon.socket_path(session.data_dir)
+    if not os.path.exists(socketpath):
+        return None
+    request = {key: value for key, value in args.items() if key != "func"}
+    return aux.send_to_daemon(socketpath, names[args["func"]], request)
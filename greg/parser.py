@@ -16,6 +16,8 @@
 # along with Greg.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import os.path
+import sys
 import time
 from urllib.parse import urlparse
 
@@ -43,11 +45,22 @@ def url(string):
         raise argparse.ArgumentTypeError(msg)
     return string
 
+# defining the shard type
+def shard(string):
+    try:
+        number, total = [int(part) for part in string.split("/")]
+        if not 1 <= number <= total:
+            raise ValueError
+    except ValueError:
+        msg = "the shard should be in the form i/N, with 1 <= i <= N"
+        raise argparse.ArgumentTypeError(msg)
+    return number, total
+
 # create the top-level parser
 parser = argparse.ArgumentParser()
-parser.add_argument('--configfile', '-cf',
+parser.add_argument('--configfile', '-cf', type=os.path.abspath,
                     help='specifies the config file that greg should use')
-parser.add_argument('--datadirectory', '-dtd',
+parser.add_argument('--datadirectory', '-dtd', type=os.path.abspath,
                     help='specifies the directory where greg keeps its data')
 subparsers = parser.add_subparsers()
 
@@ -85,10 +98,28 @@ parser_sync.add_argument('names', help='the name(s) of the feed(s) you want to\
                          sync', nargs='*', default='all')
 parser_sync.add_argument('--downloadhandler', '-dh', help='whatever you want\
                          greg to do with the enclosure')
-parser_sync.add_argument('--downloaddirectory', '-dd', help='the directory to\
-                         which you want to save your downloads')
+parser_sync.add_argument('--downloaddirectory', '-dd', type=os.path.abspath,
+                         help='the directory to which you want to save your\
+                         downloads')
 parser_sync.add_argument('--firstsync', '-fs', help='the number of files to\
                          download (if this is the first sync)')
+parser_sync.add_argument('--jobs', '-j', dest='max_parallel_feeds', type=int,
+                         help='the number of feeds to fetch and parse at the\
+                         same time')
+parser_sync.add_argument('--shard', type=shard, help='only sync the i-th of N\
+                         roughly equal parts of the feeds (given as i/N), so\
+                         that N greg processes can share them')
+parser_sync.add_argument('--due', action='store_true', help='only sync the\
+                         feeds that, judging by how often they publish, are\
+                         likely to have new entries')
+parser_sync.add_argument('--deadline', dest='sync_deadline', type=int,
+                         help='the number of seconds after which greg should\
+                         stop starting new fetches and downloads')
+parser_sync.add_argument('--trace', type=os.path.abspath, metavar='FILE',
+                         help='time each phase of the sync, write the timings\
+                         to FILE (for Chrome or Perfetto) and print a summary')
+parser_sync.add_argument('--events', action='store_true', help='write each\
+                         timed phase of the sync to stderr, as a line of JSON')
 parser_sync.set_defaults(func=commands.sync)
 
 # create the parser for the "check" command
@@ -104,12 +135,16 @@ parser_download = subparsers.add_parser('download', help='downloads particular\
                                         issues of a feed')
 parser_download.add_argument('number', help='the issue numbers you want to\
                              download', nargs="*")
+parser_download.add_argument('--feed', '-f', help='the feed whose issues you\
+                             want to download, as numbered by the last "greg\
+                             check" of it (by default, the last feed checked)')
 parser_download.add_argument('--mime', help='(part of) the mime type of the\
                              enclosure to download')
 parser_download.add_argument('--downloadhandler', '-dh', help='whatever you\
                              want greg to do with the enclosure')
-parser_download.add_argument('--downloaddirectory', '-dd', help='the directory\
-                             to which you want to save your downloads')
+parser_download.add_argument('--downloaddirectory', '-dd',
+                             type=os.path.abspath, help='the directory to\
+                             which you want to save your downloads')
 parser_download.set_defaults(func=commands.download)
 
 # create the parser for the "remove" command
@@ -120,6 +155,30 @@ parser_remove.add_argument('-f', '--force', help='remove without\
                             asking for confirmation', action='store_true')
 parser_remove.set_defaults(func=commands.remove)
 
+# create the parser for the "stats" command
+parser_stats = subparsers.add_parser('stats', help='shows how past syncs\
+                                     went')
+parser_stats.add_argument('names', help='the name(s) of the feed(s) you want\
+                          statistics of', nargs='*', default='all')
+parser_stats.add_argument('--days', type=int, default=30, help='the number of\
+                          days to look back (default: 30)')
+parser_stats.add_argument('--top', type=int, default=10, help='the number of\
+                          slowest and failing feeds to show (default: 10)')
+parser_stats.set_defaults(func=commands.stats)
+
+# create the parser for the "compact" command
+parser_compact = subparsers.add_parser('compact', help='tidies up the history\
+                                       of feed(s)')
+parser_compact.add_argument('names', help='the name(s) of the feed(s) whose\
+                            history you want to compact', nargs='*',
+                            default='all')
+parser_compact.set_defaults(func=commands.compact)
+
+# create the parser for the "daemon" command
+parser_daemon = subparsers.add_parser('daemon', help='keeps greg running,\
+                                      syncing feeds when they are due')
+parser_daemon.set_defaults(func=commands.daemon)
+
 # create the parser for the 'retrieveglobalconf' command
 parser_rgc = subparsers.add_parser('retrieveglobalconf', aliases=['rgc'],
                                    help='retrieves the path to the global\
@@ -137,4 +196,8 @@ def main():
     except AttributeError:
         parser.print_usage()
         parser.exit(1)
+    # If a greg daemon is running, sync, info and list are left to it
+    status = commands.forward(vars(args))
+    if status is not None:
+        sys.exit(status)
     function(vars(args))
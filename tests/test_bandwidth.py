@@ -0,0 +1,80 @@
+"""
+Tests for the bandwidth limits (total_bandwidth and feed_bandwidth)
+"""
+import time
+
+import pytest
+
+import greg.aux_functions as aux
+import greg.classes as c
+
+
+def minutes(hours, minutes=0):
+    return hours * 60 + minutes
+
+
+def test_plain_rates():
+    assert aux.parse_bandwidth("unlimited") == ([], None)
+    assert aux.parse_bandwidth("500") == ([], 500)
+    assert aux.parse_bandwidth("2K") == ([], 2048)
+    assert aux.parse_bandwidth("1.5m") == ([], 1.5 * 2**20)
+    assert aux.parse_bandwidth("1G") == ([], 2**30)
+
+
+def test_zero_means_unlimited():
+    assert aux.parse_bandwidth("0") == ([], None)
+
+
+def test_windows():
+    windows, default = aux.parse_bandwidth("01:00-06:00 unlimited, 2M")
+    assert windows == [(minutes(1), minutes(6), None)]
+    assert default == 2 * 2**20
+
+
+def test_window_without_default():
+    assert aux.parse_bandwidth("22:30-7:15 100K") == (
+        [(minutes(22, 30), minutes(7, 15), 100 * 2**10)], None)
+
+
+@pytest.mark.parametrize("value", ["fast", "2Q", "01:00-06:00 lots", "-1"])
+def test_invalid(value):
+    with pytest.raises(ValueError):
+        aux.parse_bandwidth(value)
+
+
+def at(hours, minutes=0):
+    """
+    The time since the epoch of today at the given local time
+    """
+    moment = time.localtime()
+    return time.mktime((moment.tm_year, moment.tm_mon, moment.tm_mday,
+                        hours, minutes, 0, 0, 0, -1))
+
+
+def test_current_bandwidth():
+    schedule = aux.parse_bandwidth("01:00-06:00 unlimited, 2M")
+    assert aux.current_bandwidth(schedule, at(3)) is None
+    assert aux.current_bandwidth(schedule, at(6)) == 2 * 2**20
+    assert aux.current_bandwidth(schedule, at(0, 59)) == 2 * 2**20
+
+
+def test_current_bandwidth_across_midnight():
+    schedule = aux.parse_bandwidth("22:00-02:00 1K, 5K")
+    assert aux.current_bandwidth(schedule, at(23)) == 2**10
+    assert aux.current_bandwidth(schedule, at(1)) == 2**10
+    assert aux.current_bandwidth(schedule, at(12)) == 5 * 2**10
+
+
+def test_bucket_reads_its_limit_lazily():
+    bucket = c.TokenBucket("total_bandwidth", "2Q")
+    with pytest.raises(ValueError, match="total_bandwidth"):
+        bucket.reserve(1000)
+
+
+def test_bucket_unlimited():
+    assert c.TokenBucket("total_bandwidth", "unlimited").reserve(10**9) == 0
+
+
+def test_bucket_goes_into_debt():
+    bucket = c.TokenBucket("feed_bandwidth", "1000")
+    assert bucket.reserve(2000) == pytest.approx(2, abs=0.1)
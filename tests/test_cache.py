@@ -0,0 +1,95 @@
+"""
+Tests for the cache of fetched feeds
+"""
+import os
+import time
+
+import pytest
+
+import greg.aux_functions as aux
+import greg.classes as c
+
+
+def podcast(digest="abc", titles=("Episode 2", "Episode 1")):
+    feedparser = aux.load_feedparser()
+    entries = [feedparser.FeedParserDict(
+        title=title, link="http://example.com/{}.mp3".format(number),
+        links=[{"href": "http://example.com/{}.mp3".format(number),
+                "type": "audio/mpeg", "rel": "enclosure"}],
+        published_parsed=time.gmtime(86400 * number), ignored="not kept")
+        for number, title in enumerate(titles)]
+    return feedparser.FeedParserDict(
+        feed=feedparser.FeedParserDict(title="A podcast", subtitle="Talk"),
+        entries=entries, digest=digest, complete=True, etag='"1"',
+        modified=None)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return c.FeedCache(str(tmp_path / "cache"), 3)
+
+
+def test_nothing_cached(cache):
+    assert cache.load("http://example.com/feed") is None
+    assert cache.last() is None
+
+
+def test_round_trip(cache):
+    url = "http://example.com/feed"
+    cache.save(url, podcast())
+    cached = cache.load(url)
+    assert cached["digest"] == "abc"
+    assert not cached["checked"]
+    restored = cache.podcast(cached)
+    assert restored.feed.title == "A podcast"
+    assert restored.href == url
+    assert [entry.title for entry in restored.entries] == [
+        "Episode 2", "Episode 1"]
+    entry = restored.entries[1]
+    assert entry.published_parsed == time.gmtime(86400)
+    assert entry.links[0].href == "http://example.com/1.mp3"
+    assert "ignored" not in entry
+
+
+def test_checked_until_the_feed_changes(cache):
+    url = "http://example.com/feed"
+    cache.save(url, podcast(), checked=True)
+    cache.save(url, podcast())
+    assert cache.load(url)["checked"]
+    cache.save(url, podcast(digest="def"))
+    assert not cache.load(url)["checked"]
+
+
+def test_evicts_least_recently_used(cache):
+    urls = ["http://example.com/{}".format(number) for number in range(3)]
+    for age, url in enumerate(urls):
+        cache.save(url, podcast())
+        path = cache.path(url)
+        then = time.time() - 100 + age
+        os.utime(path, (then, then))
+    cache.load(urls[0])  # now the most recently used
+    cache.save("http://example.com/new", podcast())
+    assert cache.load(urls[0]) is not None
+    assert cache.load(urls[1]) is None
+    assert cache.load(urls[2]) is not None
+
+
+def test_forget(cache):
+    url = "http://example.com/feed"
+    cache.save(url, podcast())
+    cache.forget(url)
+    assert cache.load(url) is None
+    cache.forget(url)  # nothing there any more, which is fine
+
+
+def test_unreadable_file(cache):
+    url = "http://example.com/feed"
+    cache.save(url, podcast())
+    with open(cache.path(url), "w") as cachefile:
+        cachefile.write("{not json")
+    assert cache.load(url) is None
+
+
+def test_last(cache):
+    cache.remember_last("feed", "http://example.com/feed")
+    assert tuple(cache.last()) == ("feed", "http://example.com/feed")
@@ -0,0 +1,66 @@
+"""
+Tests for the compiled filters (the filter option)
+"""
+import pytest
+
+import greg.aux_functions as aux
+
+
+def passes(template, **values):
+    return aux.compile_filter(template)(values)
+
+
+def test_true():
+    assert passes("True")
+
+
+def test_placeholder_in_quotes():
+    template = '"BBC" in "{title}" and "Lennon" not in "{title}"'
+    assert passes(template, title="BBC news")
+    assert not passes(template, title="BBC: Lennon at 80")
+    assert not passes(template, title="CBC news")
+
+
+def test_methods():
+    template = '"{title}".lower().startswith("bbc")'
+    assert passes(template, title="BBC news")
+    assert not passes(template, title="The BBC")
+
+
+def test_placeholder_outside_quotes_is_a_literal():
+    assert passes("{number} > 3", number="5")
+    assert not passes("{number} > 3", number="2")
+    # not a literal, so it stays a string
+    assert passes("{title} == 'hello'", title="hello")
+
+
+def test_quotes_in_values_are_just_text():
+    template = '"{title}" == "a"'
+    assert not passes(template, title='a" or "a')
+    assert passes('"{title}".count(\'"\') == 2', title='say "hi"')
+
+
+def test_functions():
+    assert passes('len("{title}") < 10 and int("{number}") == 7',
+                  title="short", number="7")
+
+
+def test_compiled_once_used_many_times():
+    condition = aux.compile_filter('"{title}".endswith("1")')
+    assert [condition({"title": title}) for title in ["1", "2", "11"]] == [
+        True, False, True]
+
+
+@pytest.mark.parametrize("template", [
+    "__import__('os').system('true')",
+    "().__class__",
+    "open('/etc/passwd')",
+    "[x for x in 'abc']",
+    "lambda: 1",
+    "{title.__class__}",
+    "{title!r} == 'x'",
+    "'a' in",
+])
+def test_rejected(template):
+    with pytest.raises(ValueError):
+        aux.compile_filter(template)
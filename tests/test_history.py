@@ -0,0 +1,111 @@
+"""
+Tests for the history database, and the import of the old history files
+"""
+import json
+import os
+
+import pytest
+
+import greg.classes as c
+
+
+@pytest.fixture
+def history(tmp_path):
+    history = c.History(str(tmp_path), [])
+    yield history
+    history.connection.close()
+
+
+def write_old_history(path, lines):
+    with open(path, "w") as infofile:
+        infofile.writelines(line + "\n" for line in lines)
+
+
+def test_migrates_json_lines(tmp_path):
+    write_old_history(tmp_path / "feed", [
+        json.dumps({"entrylink": "1.mp3", "linkdate": [2024, 1, 1, 0, 0, 0]}),
+        json.dumps({"entrylink": "2.mp3", "linkdate": [2024, 1, 2, 0, 0, 0]})])
+    history = c.History(str(tmp_path), ["feed"])
+    assert history.contains("feed", "1.mp3", [2024, 1, 1, 0, 0, 0])
+    assert history.contains("feed", "2.mp3", (2024, 1, 2, 0, 0, 0))
+    assert not history.contains("feed", "2.mp3", [2024, 1, 1, 0, 0, 0])
+    assert history.latest("feed") == [2024, 1, 2, 0, 0, 0]
+    assert not os.path.exists(tmp_path / "feed")
+    assert os.path.exists(tmp_path / "feed.migrated")
+
+
+def test_migrates_old_format(tmp_path):
+    write_old_history(tmp_path / "feed", [
+        "1.mp3 [2023, 5, 6, 7, 8, 9, 5, 126, 0]",
+        "2.mp3 [2023, 5, 7, 7, 8, 9, 6, 127, 0]"])
+    history = c.History(str(tmp_path), ["feed"])
+    assert history.contains("feed", "1.mp3", [2023, 5, 6, 7, 8, 9, 5, 126, 0])
+    assert history.latest("feed") == [2023, 5, 7, 7, 8, 9, 6, 127, 0]
+
+
+def test_migrates_once(tmp_path):
+    write_old_history(tmp_path / "feed", [
+        json.dumps({"entrylink": "1.mp3", "linkdate": [2024, 1, 1]})])
+    c.History(str(tmp_path), ["feed"]).connection.close()
+    history = c.History(str(tmp_path), ["feed"])
+    assert history.linkdates("feed", 10) == [[2024, 1, 1]]
+
+
+def test_only_listed_feeds_are_migrated(tmp_path):
+    write_old_history(tmp_path / "other", [
+        json.dumps({"entrylink": "1.mp3", "linkdate": [2024, 1, 1]})])
+    history = c.History(str(tmp_path), ["feed"])
+    assert history.latest("other") is None
+    assert os.path.exists(tmp_path / "other")
+
+
+def test_add_and_latest(history):
+    assert history.latest("feed") is None
+    history.add("feed", "2.mp3", [2024, 1, 2])
+    history.add("feed", "1.mp3", [2024, 1, 1])
+    assert history.latest("feed") == [2024, 1, 2]
+    assert history.linkdates("feed", 1) == [[2024, 1, 1]]
+
+
+def test_truncate(history):
+    for day in range(1, 5):
+        history.add("feed", "{}.mp3".format(day), [2024, 1, day])
+    history.truncate("feed", [2024, 1, 3])
+    assert history.latest("feed") == [2024, 1, 2]
+    assert not history.contains("feed", "3.mp3", [2024, 1, 3])
+    history.truncate("feed", [2024, 1, 1])
+    assert history.latest("feed") is None
+
+
+def test_compact(history):
+    history.add("feed", "1.mp3", [2024, 1, 1])
+    history.add("feed", "1.mp3", [2024, 1, 1])
+    history.add("feed", "2.mp3", [2024, 1, 2])
+    assert history.compact(["feed"]) == 1
+    assert history.linkdates("feed", 10) == [[2024, 1, 2], [2024, 1, 1]]
+    assert not history.needs_compacting(0)
+
+
+def test_cutoff_stops_at_pending_entries(history):
+    history.add("feed", "1.mp3", [2024, 1, 1, 0, 0, 0])
+    history.hold("feed", "2.mp3", [2024, 1, 2, 0, 0, 0, 1, 2, 0])
+    history.add("feed", "3.mp3", [2024, 1, 3, 0, 0, 0])
+    cutoff = history.cutoff("feed")
+    assert [2024, 1, 1, 0, 0, 0] < cutoff < [2024, 1, 2, 0, 0, 0, 1, 2, 0]
+    history.add("feed", "2.mp3", [2024, 1, 2, 0, 0, 0, 1, 2, 0])
+    assert history.cutoff("feed") == [2024, 1, 3, 0, 0, 0]
+
+
+def test_release(history):
+    history.add("feed", "3.mp3", [2024, 1, 3])
+    history.hold("feed", "1.mp3", [2024, 1, 1])
+    history.release("feed", [2024, 1, 2])
+    assert history.cutoff("feed") == [2024, 1, 3]
+
+
+def test_forget(history):
+    history.add("feed", "1.mp3", [2024, 1, 1])
+    history.hold("feed", "2.mp3", [2024, 1, 2])
+    history.forget("feed")
+    assert history.cutoff("feed") is None
+    assert not history.contains("feed", "1.mp3", [2024, 1, 1])
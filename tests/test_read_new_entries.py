@@ -0,0 +1,137 @@
+"""
+Tests for reading only the new entries of a feed (see
+aux.read_new_entries)
+"""
+import greg.aux_functions as aux
+
+
+class FakeResponse():
+    """
+    Stand in for a streamed requests response, handing out the document in
+    small chunks
+    """
+    def __init__(self, document, chunk_size=64):
+        self.chunks = [document[start:start + chunk_size] for start in
+                       range(0, len(document), chunk_size)]
+        self.read = 0  # chunks handed out
+        self.closed = False
+        self.iterated = False
+
+    def iter_content(self, chunk_size):
+        # like requests, the content can only be gone through once
+        assert not self.iterated, "the response has been read already"
+        self.iterated = True
+        for chunk in self.chunks:
+            self.read += 1
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+RSS = """<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0" xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd">
+<channel>
+<title>A podcast</title>
+<itunes:author>Someone</itunes:author>
+{}
+</channel>
+</rss>
+"""
+
+ITEM = """<item>
+<title>Episode {day}</title>
+<pubDate>{weekday}, {day:02} Jan 2024 12:00:00 GMT</pubDate>
+<itunes:duration>00:{day:02}:00</itunes:duration>
+<enclosure url="http://example.com/{day}.mp3" type="audio/mpeg"
+ length="1000"/>
+</item>"""
+
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+
+def rss(days):
+    items = [ITEM.format(day=day, weekday=WEEKDAYS[(day - 1) % 7])
+             for day in days]
+    return RSS.format("\n".join(items)).encode()
+
+
+# after the entries of January 4th, before those of the 5th
+STOP_AT = [2024, 1, 4, 13, 0, 0]
+
+
+def test_stops_after_old_entries():
+    response = FakeResponse(rss(range(20, 0, -1)))
+    content, complete = aux.read_new_entries(response, STOP_AT,
+                                             old_entries=3)
+    assert not complete
+    assert response.closed
+    assert response.read < len(response.chunks)
+    parsed = aux.load_feedparser().parse(content)
+    # the new entries, and three old ones
+    assert [entry.title for entry in parsed.entries] == [
+        "Episode {}".format(day) for day in range(20, 1, -1)]
+
+
+def test_namespaces_survive():
+    response = FakeResponse(rss(range(10, 0, -1)))
+    content, complete = aux.read_new_entries(response, STOP_AT)
+    assert not complete
+    parsed = aux.load_feedparser().parse(content)
+    assert not parsed.bozo
+    assert parsed.feed.title == "A podcast"
+    assert parsed.feed.author == "Someone"
+    entry = parsed.entries[0]
+    assert entry.itunes_duration == "00:10:00"
+    assert entry.enclosures[0]["href"] == "http://example.com/10.mp3"
+    assert tuple(entry.published_parsed)[:6] == (2024, 1, 10, 12, 0, 0)
+
+
+def test_atom():
+    entries = "\n".join(
+        """<entry><title>Episode {day}</title><id>{day}</id>
+        <updated>2024-01-{day:02}T12:00:00Z</updated>
+        <link rel="enclosure" href="http://example.com/{day}.mp3"
+         type="audio/mpeg"/></entry>""".format(day=day)
+        for day in range(10, 0, -1))
+    document = """<?xml version="1.0" encoding="UTF-8"?>
+    <feed xmlns="http://www.w3.org/2005/Atom"><title>A podcast</title>
+    {}</feed>""".format(entries).encode()
+    content, complete = aux.read_new_entries(FakeResponse(document), STOP_AT)
+    assert not complete
+    parsed = aux.load_feedparser().parse(content)
+    assert parsed.feed.title == "A podcast"
+    assert [entry.title for entry in parsed.entries] == [
+        "Episode {}".format(day) for day in range(10, 1, -1)]
+    assert parsed.entries[0].enclosures[0]["href"] == (
+        "http://example.com/10.mp3")
+
+
+def test_nothing_old_enough():
+    document = rss(range(10, 0, -1))
+    response = FakeResponse(document)
+    content, complete = aux.read_new_entries(response, [2023, 1, 1])
+    assert complete
+    assert content == document
+
+
+def test_out_of_order():
+    document = rss([10, 9, 3, 8, 2, 1])
+    content, complete = aux.read_new_entries(FakeResponse(document), STOP_AT)
+    assert complete
+    assert content == document
+
+
+def test_undated():
+    document = rss(range(10, 0, -1)).replace(
+        b"<pubDate>Sun, 07 Jan 2024 12:00:00 GMT</pubDate>", b"")
+    content, complete = aux.read_new_entries(FakeResponse(document), STOP_AT)
+    assert complete
+    assert content == document
+
+
+def test_parse_error():
+    document = rss(range(10, 0, -1)).replace(b"</title>", b"</titel>", 1)
+    content, complete = aux.read_new_entries(FakeResponse(document), STOP_AT)
+    assert complete
+    assert content == document
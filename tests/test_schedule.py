@@ -0,0 +1,51 @@
+"""
+Tests for the choice of feeds that "greg sync --due" fetches
+"""
+import time
+
+import pytest
+
+import greg.classes as c
+
+
+@pytest.fixture
+def session(tmp_path):
+    configfile = tmp_path / "greg.conf"
+    configfile.write_text("[DEFAULT]\nfailure_threshold = 3\n"
+                          "failure_cooldown = 800\n")
+    (tmp_path / "data").write_text("[feed]\nurl = http://example.com/\n")
+    return c.Session({"configfile": str(configfile),
+                      "datadirectory": str(tmp_path)})
+
+
+def test_new_feed_is_due(session):
+    assert session.is_due("feed")
+
+
+def test_retry_delay(session):
+    assert session.retry_delay(1) == 200
+    assert session.retry_delay(2) == 400
+    assert session.retry_delay(3) == 800
+    assert session.retry_delay(7) == 800
+
+
+def test_failed_feed_waits(session):
+    session.record_failure("feed")
+    assert not session.is_due("feed")
+    then = time.time() - 201
+    session.set_feed_option("feed", "last_checked", str(int(then)))
+    assert session.is_due("feed")
+
+
+def test_failed_feed_is_suspended(session):
+    for _ in range(3):
+        session.record_failure("feed")
+    assert session.suspended_until("feed")
+    session.record_success("feed")
+    assert not session.suspended_until("feed")
+
+
+def test_no_threshold_no_delay(session):
+    session.config.set("DEFAULT", "failure_threshold", "0")
+    session.record_failure("feed")
+    assert session.is_due("feed")
@@ -0,0 +1,135 @@
+"""
+Tests for the sync statistics ('greg stats')
+"""
+import types
+
+import pytest
+
+import greg.aux_functions as aux
+import greg.classes as c
+
+
+def test_percentile_interpolates():
+    values = [1, 2, 3, 4, 5]
+    assert aux.percentile(values, 0) == 1
+    assert aux.percentile(values, 0.5) == 3
+    assert aux.percentile(values, 1) == 5
+    assert aux.percentile(values, 0.9) == pytest.approx(4.6)
+
+
+def test_percentile_sorts_and_skips_none():
+    assert aux.percentile([5, None, 1, 3], 0.5) == 3
+
+
+def test_percentile_of_nothing():
+    assert aux.percentile([], 0.5) is None
+    assert aux.percentile([None], 0.5) is None
+
+
+def test_percentile_of_one_value():
+    assert aux.percentile([7], 0.99) == 7
+
+
+def span(phase, duration=1.0, **args):
+    args.setdefault("outcome", "ok")
+    return (phase, 0.0, duration, 1, args)
+
+
+def test_summarize():
+    spans = [span("fetch", 0.5, feed="a", status=200, bytes=1000),
+             span("parse", feed="a", entries=3),
+             span("filter", feed="a", entry="1.mp3", passed=True),
+             span("filter", feed="a", entry="2.mp3", passed=False),
+             span("download", 2.0, feed="a", entry="1.mp3", bytes=5000),
+             span("history")]
+    figures = c.Stats.summarize(spans)
+    assert list(figures) == ["a"]
+    assert figures["a"] == dict(
+        fetch_time=0.5, status=200, size=1000, entries=3, new=2,
+        downloaded=5000, download_time=2.0, failures=0)
+
+
+def test_summarize_not_modified():
+    figures = c.Stats.summarize([span("fetch", feed="a", status=304,
+                                      bytes=0, outcome="not modified")])
+    assert figures["a"]["size"] is None
+    assert figures["a"]["failures"] == 0
+
+
+def test_only_fetches_downloads_and_stages_fail():
+    spans = [span("html_to_text", feed="a", outcome="AttributeError"),
+             span("fetch", feed="a", outcome="URLError"),
+             span("download", feed="a", entry="1.mp3", bytes=10,
+                  outcome="RuntimeError"),
+             span("tag", feed="a", entry="2.mp3", outcome="OSError"),
+             span("stage check", feed="a", entry="2.mp3",
+                  outcome="RuntimeError")]
+    figures = c.Stats.summarize(spans)
+    assert figures["a"]["failures"] == 4
+    assert figures["a"]["downloaded"] == 0
+
+
+def test_tracer_failed():
+    assert not c.Tracer.failed("html_to_text", {"outcome": "AttributeError"})
+    assert not c.Tracer.failed("fetch", {"outcome": "not modified"})
+    assert c.Tracer.failed("fetch", {"outcome": "HTTPError"})
+    assert c.Tracer.failed("stage convert", {"outcome": "RuntimeError"})
+
+
+class FakeFeed():
+    """
+    Just enough of a Feed for the PostProcessor
+    """
+    name = "a"
+
+    def __init__(self, session, stages):
+        self.session = session
+        self.stages = stages
+        self.history = []
+
+    def post_download_stages(self, placeholders):
+        return self.stages, []
+
+    def append_history(self, podname, linkdate):
+        self.history.append(podname)
+
+    def forget_validators(self):
+        pass
+
+    def start_job(self):
+        pass
+
+    def finish_job(self):
+        pass
+
+
+class FakeSession():
+    def __init__(self, workers):
+        self.workers = workers
+        self.tracer = c.Tracer(keep=True)
+
+    def retrieve_config(self, value, default):
+        return self.workers if value == "max_parallel_stages" else default
+
+
+@pytest.mark.parametrize("workers", ["0", "1"])
+def test_failed_stages_are_counted(tmp_path, workers):
+    enclosure = tmp_path / "1.mp3"
+    enclosure.write_bytes(b"audio")
+    session = FakeSession(workers)
+    feed = FakeFeed(session, [("command", "good", ["true"]),
+                              ("command", "bad", ["false"])])
+    postprocessor = c.PostProcessor(session)
+    placeholders = types.SimpleNamespace(fullpath=str(enclosure))
+    try:
+        postprocessor.submit(feed, placeholders, "1.mp3", [2024, 1, 1])
+    except aux.StageError:
+        assert workers == "0"  # on the spot, the error goes to the caller
+    finally:
+        postprocessor.wait()
+    spans = session.tracer.recorded()
+    assert [(phase, args["outcome"]) for phase, _, _, _, args in spans] == [
+        ("stage good", "ok"), ("stage bad", "RuntimeError")]
+    assert c.Stats.summarize(spans)["a"]["failures"] == 1
+    assert feed.history == []
+    assert not enclosure.exists()